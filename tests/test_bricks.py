@@ -0,0 +1,49 @@
+"""
+Tests of splitting volumes into bricks.
+"""
+
+import numpy as np
+import pytest
+from volume_gizmos import bricks
+
+def covered(shape, slices):
+    count = np.zeros(shape, dtype=np.int32)
+    for brick in slices:
+        count[brick] += 1
+    return count
+
+def test_volume_that_fits_is_one_brick():
+    assert bricks.brick_slices((10, 20, 30), 6000) == [(slice(0, 10), slice(0, 20), slice(0, 30))]
+
+def test_bricks_cover_with_overlap():
+    shape = (20, 17, 13)
+    max_voxels = 1000
+    slices = bricks.brick_slices(shape, max_voxels)
+    shapes = set(tuple(s.stop - s.start for s in brick) for brick in slices)
+    assert len(shapes) == 1
+    assert int(np.prod(shapes.pop())) <= max_voxels
+    assert covered(shape, slices).min() >= 1
+    # neighbouring bricks share at least one plane along every split axis.
+    for axis in range(3):
+        starts = sorted(set(brick[axis].start for brick in slices))
+        stops = sorted(set(brick[axis].stop for brick in slices))
+        assert all(start < stop for (start, stop) in zip(starts[1:], stops[:-1]))
+
+def test_brick_shape_uses_fewest_bricks():
+    assert bricks.brick_shape((100, 10, 10), 5500) == [51, 10, 10]
+    assert bricks.split_count(100, 51, 1) == 2
+    assert bricks.split_count(100, 1, 1) is None
+
+def test_max_brick_voxels():
+    assert bricks.max_brick_voxels(4096 + bricks.HEADER_BYTES) == 1024
+
+def test_too_many_bricks():
+    shape = (10000, 10000, 10000)
+    max_voxels = bricks.max_brick_voxels()
+    with pytest.raises(ValueError):
+        bricks.brick_slices(shape, max_voxels)
+    assert len(bricks.brick_slices((2048, 2048, 2048), max_voxels)) <= bricks.MAX_BRICKS
+    assert len(bricks.brick_slices((40, 40, 40), 1000, max_bricks=None)) > 8
+
+def test_describe():
+    assert bricks.describe((slice(0, 5), slice(2, 4), slice(1, 3))) == "[0:5, 2:4, 1:3]"
@@ -0,0 +1,153 @@
+"""
+Tests of the volume loaders: boxes and strides, lazy chunked reads, reduction and scaling.
+"""
+
+import itertools
+import json
+import os
+import numpy as np
+import pytest
+from volume_gizmos import loaders
+
+class ArrayVolume(loaders.LazyVolume):
+    "LazyVolume over an in-memory array, recording the source reads."
+
+    def __init__(self, array, chunks=None, box=None, stride=None):
+        self.array = array
+        self.chunks = chunks
+        self.reads = []
+        super().__init__(array.shape, array.dtype, box=box, stride=stride)
+
+    def read_source(self, slices):
+        self.reads.append(tuple(slices))
+        return self.array[tuple(slices)]
+
+def volume(shape=(10, 11, 12), dtype=np.int32):
+    return np.arange(int(np.prod(shape)), dtype=dtype).reshape(shape)
+
+def test_box_slices():
+    slices = loaders.box_slices((10, 20, 30), [(2, 8), None, (5, None)], [1, 2, 3])
+    assert list(slices) == [slice(2, 8, 1), slice(0, 20, 2), slice(5, 30, 3)]
+
+def test_box_slices_rejects_bad_stride():
+    with pytest.raises(ValueError):
+        loaders.box_slices((10, 10, 10), None, 0)
+
+def test_parse_box_and_stride():
+    assert loaders.parse_box("0:100,:,10:50") == [(0, 100), (None, None), (10, 50)]
+    assert loaders.parse_stride("2") == 2
+    assert loaders.parse_stride("1,2,2") == [1, 2, 2]
+
+def test_lazy_indexing_matches_numpy():
+    array = volume()
+    lazy = ArrayVolume(array, box=[(1, 9), (2, None), None], stride=[2, 1, 3])
+    expected = array[1:9:2, 2::1, ::3]
+    assert lazy.shape == expected.shape
+    assert np.array_equal(np.asarray(lazy), expected)
+    assert np.array_equal(lazy[1:3, ..., 2], expected[1:3, ..., 2])
+    assert np.array_equal(lazy[-1, ::2], expected[-1, ::2])
+    assert lazy[2:2].shape == (0,) + expected.shape[1:]
+    with pytest.raises(IndexError):
+        lazy[expected.shape[0]]
+
+def test_slab_bounds_align_to_chunk_rows():
+    lazy = ArrayVolume(volume((20, 8, 8)), chunks=(4, 8, 8))
+    plane_bytes = 8 * 8 * 4
+    bounds = list(lazy.slab_bounds(slab_bytes=6 * plane_bytes))
+    assert bounds == [(0, 4), (4, 8), (8, 12), (12, 16), (16, 20)]
+    bounds = list(lazy.slab_bounds(slab_bytes=8 * plane_bytes))
+    assert bounds == [(0, 8), (8, 16), (16, 20)]
+
+def test_slab_bounds_of_strided_chunks():
+    lazy = ArrayVolume(volume((20, 4, 4)), chunks=(4, 4, 4), box=[(1, 19), None, None], stride=[3, 1, 1])
+    # selected planes 1, 4, 7, 10, 13, 16 lie in chunk rows 0, 1, 1, 2, 3, 4
+    bounds = list(lazy.slab_bounds(slab_bytes=1))
+    assert bounds == [(0, 1), (1, 3), (3, 4), (4, 5), (5, 6)]
+    out = lazy.read(slab_bytes=1)
+    assert np.array_equal(out, volume((20, 4, 4))[1:19:3])
+
+def test_h5_lazy_box_and_stride(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    array = volume((16, 12, 10), np.uint16)
+    fn = str(tmp_path / "volume.h5")
+    with h5py.File(fn, "w") as f:
+        f.create_dataset("data", data=array, chunks=(4, 6, 5), compression="gzip")
+    box = [(1, 15), (2, 11), None]
+    lazy = loaders.load_h5(fn, box=box, stride=[2, 3, 1], lazy=True)
+    try:
+        expected = array[1:15:2, 2:11:3, :]
+        assert lazy.chunks == (4, 6, 5)
+        assert np.array_equal(lazy.read(slab_bytes=1), expected)
+        assert np.array_equal(lazy[2:5, 1], expected[2:5, 1])
+    finally:
+        lazy.close()
+    assert np.array_equal(loaders.load_h5(fn, stride=2), array[::2, ::2, ::2])
+
+def write_zarr(path, array, chunks, fill_value=0, skip=()):
+    "Write an uncompressed Zarr version 2 array store, leaving out the chunks in skip."
+    os.makedirs(path)
+    metadata = dict(zarr_format=2, shape=list(array.shape), chunks=list(chunks), dtype=array.dtype.str,
+        order="C", fill_value=fill_value, compressor=None, filters=None)
+    with open(os.path.join(path, ".zarray"), "w") as f:
+        json.dump(metadata, f)
+    grid = [range(-(-n // c)) for (n, c) in zip(array.shape, chunks)]
+    for index in itertools.product(*grid):
+        if index in skip:
+            continue
+        chunk = np.full(chunks, fill_value, dtype=array.dtype)
+        part = array[tuple(slice(q * c, (q + 1) * c) for (q, c) in zip(index, chunks))]
+        chunk[tuple(slice(0, n) for n in part.shape)] = part
+        with open(os.path.join(path, ".".join(str(q) for q in index)), "wb") as f:
+            f.write(chunk.tobytes())
+
+def test_zarr_lazy_chunk_reads(tmp_path):
+    array = volume((13, 9, 7), np.float32)
+    path = str(tmp_path / "volume.zarr")
+    write_zarr(path, array, (4, 4, 4))
+    lazy = loaders.load_zarr(path, box=[(2, 12), None, (1, 7)], stride=[3, 2, 1], lazy=True, threads=2)
+    expected = array[2:12:3, ::2, 1:7]
+    assert lazy.chunks == (4, 4, 4)
+    assert np.array_equal(np.asarray(lazy), expected)
+    assert np.array_equal(lazy[1:, 2:4, ::2], expected[1:, 2:4, ::2])
+    assert np.array_equal(loaders.load_zarr(path, stride=2), array[::2, ::2, ::2])
+
+def test_zarr_missing_chunks_use_fill_value(tmp_path):
+    array = np.ones((8, 8, 8), dtype=np.uint8)
+    path = str(tmp_path / "sparse.zarr")
+    write_zarr(path, array, (4, 4, 4), fill_value=7, skip=[(1, 1, 1)])
+    lazy = loaders.load_zarr(path, lazy=True)
+    assert lazy[0, 0, 0] == 1
+    assert lazy[7, 7, 7] == 7
+    assert int(np.asarray(lazy).sum()) == 512 - 64 + 7 * 64
+
+def test_downsample_factors():
+    assert loaders.downsample_factors((100, 100, 100), downsample=2) == [2, 2, 2]
+    assert loaders.downsample_factors((4, 100, 100), downsample=[8, 2, 1]) == [4, 2, 1]
+    factors = loaders.downsample_factors((100, 100, 100), max_voxels=100000)
+    assert int(np.prod([n // f for (n, f) in zip((100, 100, 100), factors)])) <= 100000
+
+def test_block_reduce():
+    array = volume((6, 4, 5), np.uint8)
+    reduced = loaders.block_reduce(array, [2, 2, 2], threads=2)
+    expected = np.rint(array[:, :, :4].reshape(3, 2, 2, 2, 2, 2).mean(axis=(1, 3, 5)))
+    assert reduced.dtype == np.uint8
+    assert np.array_equal(reduced, expected)
+    sampled = loaders.block_reduce(array, [2, 2, 2], method="subsample")
+    assert np.array_equal(sampled, array[1:6:2, 1:4:2, 1:4:2])
+
+def test_value_range_skips_nan():
+    array = np.linspace(-1, 1, 60).reshape(3, 4, 5)
+    array[0, 0, 0] = np.nan
+    array[2, 3, 4] = np.inf
+    (mn, mx) = loaders.value_range(array)
+    assert (mn, mx) == (array[0, 0, 1], array[2, 3, 3])
+    assert loaders.value_range(np.full((2, 2, 2), np.nan)) == (0, 0)
+
+def test_scale_to_bytes():
+    array = np.linspace(10, 20, 60).reshape(3, 4, 5)
+    array[1, 1, 1] = np.nan
+    scaled = loaders.scale_to_bytes(array, threads=2)
+    assert scaled.dtype == np.uint8
+    assert (scaled[0, 0, 0], scaled[-1, -1, -1]) == (0, 255)
+    assert scaled[1, 1, 1] == 0
+    assert np.all(np.diff(np.delete(scaled.reshape(-1), 26).astype(int)) >= 0)
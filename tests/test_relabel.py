@@ -0,0 +1,70 @@
+"""
+Tests of label compaction.
+"""
+
+import numpy as np
+from volume_gizmos import relabel
+
+def restored(compacted, original_ids):
+    if original_ids is None:
+        return compacted.astype(np.int64)
+    return original_ids[compacted]
+
+def test_small_labels_keep_their_ids():
+    labels = np.array([0, 3, 3, 200, 1000], dtype=np.int64).reshape(1, 1, 5)
+    (compacted, original_ids) = relabel.compact_labels(labels)
+    assert original_ids is None
+    assert compacted.dtype == np.uint16
+    assert np.array_equal(compacted, labels)
+    assert relabel.original_label(original_ids, 200) == 200
+
+def test_uint8_labels_are_not_copied():
+    labels = np.arange(27, dtype=np.uint8).reshape(3, 3, 3)
+    (compacted, original_ids) = relabel.compact_labels(labels)
+    assert compacted is labels and original_ids is None
+
+def test_large_labels_are_compacted():
+    labels = np.array([[[0, 70000, 5], [5, 2 ** 40, 0]]], dtype=np.int64)
+    (compacted, original_ids) = relabel.compact_labels(labels, threads=2)
+    assert compacted.dtype == np.uint8
+    assert list(original_ids) == [0, 5, 70000, 2 ** 40]
+    assert compacted[0, 0, 0] == 0
+    assert np.array_equal(restored(compacted, original_ids), labels)
+    assert relabel.original_label(original_ids, compacted[0, 1, 1]) == 2 ** 40
+
+def test_negative_labels_are_compacted():
+    labels = np.array([[[-3, 0, 7], [-3, 12, -100]]], dtype=np.int32)
+    (compacted, original_ids) = relabel.compact_labels(labels)
+    assert list(original_ids) == [0, -100, -3, 7, 12]
+    assert compacted[0, 0, 1] == 0
+    assert np.array_equal(restored(compacted, original_ids), labels)
+
+def test_float_labels_are_compacted():
+    labels = np.array([[[0.0, 1e6, 2.5e6, 1e6]]])
+    (compacted, original_ids) = relabel.compact_labels(labels)
+    assert np.array_equal(restored(compacted, original_ids), labels)
+
+def test_edits_keep_label_numbers():
+    labels = np.array([[[0, 100000, 300000, 500000]]], dtype=np.int64)
+    (compacted, original_ids) = relabel.compact_labels(labels)
+    edited = labels.copy()
+    edited[0, 0, 0] = 200000
+    (recompacted, new_ids) = relabel.compact_labels(edited, original_ids=original_ids)
+    assert list(new_ids) == [0, 100000, 300000, 500000, 200000]
+    assert np.array_equal(recompacted[0, 0, 1:], compacted[0, 0, 1:])
+    assert np.array_equal(restored(recompacted, new_ids), edited)
+
+def test_raw_labels_grow_into_compacted_labels():
+    labels = np.array([[[0, 4, 9]]], dtype=np.int64)
+    (compacted, original_ids) = relabel.compact_labels(labels)
+    assert original_ids is None
+    edited = labels.copy()
+    edited[0, 0, 0] = 100000
+    (recompacted, new_ids) = relabel.compact_labels(edited, original_ids=np.arange(10))
+    assert np.array_equal(recompacted[0, 0, 1:], [4, 9])
+    assert new_ids[recompacted[0, 0, 0]] == 100000
+
+def test_label_dtype():
+    assert relabel.label_dtype(255) == np.uint8
+    assert relabel.label_dtype(256) == np.uint16
+    assert relabel.label_dtype(70000) == np.uint32
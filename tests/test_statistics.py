@@ -0,0 +1,66 @@
+"""
+Tests of the cached volume statistics.
+"""
+
+import gc
+import numpy as np
+from volume_gizmos import statistics
+
+def test_uint8_counts_every_value():
+    array = np.array([0, 0, 3, 3, 3, 250], dtype=np.uint8).reshape(1, 2, 3)
+    stats = statistics.compute_statistics(array)
+    assert stats.value_range == (0, 250)
+    assert stats.nonzero == 4
+    assert stats.size == 6
+    assert stats.counts[stats.levels == 3][0] == 3
+    assert stats.percentile(50) == 3
+
+def test_int16_negative_values():
+    array = np.array([-5, -5, 0, 7], dtype=np.int16).reshape(1, 2, 2)
+    stats = statistics.compute_statistics(array)
+    assert stats.value_range == (-5, 7)
+    assert stats.nonzero == 3
+    assert list(stats.levels[stats.counts > 0]) == [-5, 0, 7]
+
+def test_float_statistics_skip_nan():
+    array = np.linspace(0, 1, 1000).reshape(10, 10, 10)
+    array[0, 0, :3] = np.nan
+    array[9, 9, 9] = np.inf
+    stats = statistics.compute_statistics(array, bins=100, threads=2)
+    assert stats.minimum == array[0, 0, 3]
+    assert stats.maximum == array[9, 9, 8]
+    assert stats.size == 996
+    # NaN and infinity count as nonzero (the only zero was replaced by NaN).
+    assert stats.nonzero == 1000
+    (low, high) = stats.percentiles([10, 90])
+    assert abs(low - 0.1) < 0.02 and abs(high - 0.9) < 0.02
+    assert abs(stats.otsu_level() - 0.5) < 0.02
+
+def test_all_nan():
+    stats = statistics.compute_statistics(np.full((2, 2, 2), np.nan, dtype=np.float32))
+    assert stats.value_range == (0, 0)
+    assert stats.size == 0
+
+def test_constant_volume():
+    stats = statistics.compute_statistics(np.full((3, 3, 3), 2.5))
+    assert stats.value_range == (2.5, 2.5)
+    assert stats.otsu_level() == 2.5
+    assert stats.step() == 1
+
+def test_step():
+    stats = statistics.compute_statistics(np.arange(1000, dtype=np.uint16).reshape(10, 10, 10))
+    assert stats.step() == 3
+    stats = statistics.compute_statistics(np.linspace(0, 1, 1000).reshape(10, 10, 10))
+    assert 0 < stats.step() < 0.01
+
+def test_cache_and_invalidate():
+    array = np.arange(64, dtype=np.int32).reshape(4, 4, 4)
+    stats = statistics.volume_statistics(array)
+    assert statistics.volume_statistics(array) is stats
+    array[0, 0, 0] = -10
+    statistics.invalidate(array)
+    assert statistics.volume_statistics(array).minimum == -10
+    key = id(array)
+    del array
+    gc.collect()
+    assert key not in statistics.cache
@@ -0,0 +1,93 @@
+"""
+Tests of the transfer encodings and narrowing.
+"""
+
+import zlib
+import numpy as np
+import pytest
+from volume_gizmos import transfer
+
+def test_rle_round_trip():
+    array = np.array([[[0, 0, 3], [3, 3, 5]], [[5, 5, 5], [0, 1, 1]]], dtype=np.uint16)
+    (values, lengths) = transfer.rle_encode(array)
+    assert list(values) == [0, 3, 5, 0, 1]
+    assert list(lengths) == [2, 3, 4, 1, 2]
+    assert lengths.dtype == np.uint32
+    assert np.array_equal(transfer.rle_decode(values, lengths), array.reshape(-1))
+
+def test_rle_empty_and_converted():
+    (values, lengths) = transfer.rle_encode(np.zeros((0, 3, 3), dtype=np.uint8))
+    assert values.size == 0 and lengths.size == 0
+    # int64 is sent as float32
+    (values, lengths) = transfer.rle_encode(np.array([7, 7, 8], dtype=np.int64))
+    assert values.dtype == np.float32
+    assert list(lengths) == [2, 1]
+
+def test_deflate_round_trip():
+    array = np.zeros((8, 16, 16), dtype=np.uint16)
+    array[2:5, 3:9, 4:12] = 1000
+    encoded = transfer.deflate_encode(array)
+    assert encoded.dtype == np.uint8
+    assert encoded.size < array.nbytes
+    decoded = np.frombuffer(zlib.decompress(encoded.tobytes()), dtype=array.dtype).reshape(array.shape)
+    assert np.array_equal(decoded, array)
+
+def test_transfer_ready_copies():
+    reasons = []
+    array = np.zeros((4, 4, 4), dtype=np.uint8)
+    assert transfer.transfer_ready(array, reasons.append) is array
+    assert reasons == []
+    transfer.transfer_ready(array[:, ::2], reasons.append)
+    transfer.transfer_ready(array.astype(np.int64), reasons.append)
+    assert reasons == ["contiguous", "astype"]
+
+def test_changed_boxes():
+    old = np.zeros((6, 5, 4), dtype=np.uint8)
+    new = old.copy()
+    new[1, 2, 3] = 1
+    new[2, 0, 1] = 1
+    new[5, 4, 0] = 1
+    boxes = transfer.changed_boxes(old, new)
+    assert boxes == [
+        (slice(1, 3), slice(0, 3), slice(1, 4)),
+        (slice(5, 6), slice(4, 5), slice(0, 1)),
+    ]
+    assert transfer.box_size(boxes[0]) == 18
+    assert transfer.changed_boxes(old, old) == []
+
+def test_narrowing_keeps_small_integers():
+    for dtype in (np.uint8, np.int8, np.uint16, np.int16):
+        array = np.arange(24, dtype=dtype).reshape(2, 3, 4)
+        assert transfer.narrowing(array) == (None, 1.0, 0.0)
+        assert transfer.apply_narrowing(array, transfer.narrowing(array)) is array
+
+def test_narrowing_shifts_integer_ranges():
+    array = np.arange(24, dtype=np.int64).reshape(2, 3, 4) * 100 - 1000
+    (narrow, scale, offset) = transfer.narrow_array(array)
+    assert narrow.dtype == np.uint16
+    assert (scale, offset) == (1.0, -1000.0)
+    assert np.array_equal(narrow * scale + offset, array)
+    small = np.arange(24, dtype=np.float64).reshape(2, 3, 4) + 0.0
+    (narrow, scale, offset) = transfer.narrow_array(small)
+    assert narrow.dtype == np.uint8
+    assert np.array_equal(narrow + offset, small)
+
+def test_narrowing_quantizes_floats():
+    array = np.linspace(-1, 1, 60).reshape(3, 4, 5)
+    assert transfer.narrowing(array)[0] == np.float32
+    for bits in (8, 16):
+        (narrow, scale, offset) = transfer.narrow_array(array, bits)
+        assert narrow.dtype == (np.uint8 if bits == 8 else np.uint16)
+        assert narrow.max() == 2 ** bits - 1
+        assert np.abs(narrow * scale + offset - array).max() <= scale / 2 + 1e-12
+    with pytest.raises(AssertionError):
+        transfer.narrowing(array, bits=12)
+
+def test_apply_narrowing_reuses_output():
+    array = np.arange(24, dtype=np.int32).reshape(2, 3, 4) + 70000
+    parameters = transfer.narrowing(array)
+    out = np.empty(array.shape, dtype=parameters[0])
+    assert transfer.apply_narrowing(array, parameters, out=out) is out
+    # a part of the array with the parameters of the whole.
+    part = transfer.apply_narrowing(array[1:], parameters)
+    assert np.array_equal(part, out[1:])
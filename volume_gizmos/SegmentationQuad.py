@@ -1,23 +1,85 @@
 
 import numpy as np
 from H5Gizmos import Html, serve, get, do, Stack, Slider, Text
-from . import VolumeSuper, loaders, color_list
+from . import VolumeSuper, loaders, color_list, volume_cache, transfer, profiling, coalesce, statistics, relabel
 import os
+import time
+
+# Replace the label colors of a SegmentationQuad view by a longer list: a new color panel
+# and new colorize actions in place of the old ones in the view's action sequences.
+CHANGE_COLORS_ARGUMENTS = ["quad", "colors"]
+CHANGE_COLORS_BODY = """
+    const context = quad.context;
+    const mix = quad.mixView;
+    const old_panel = mix.color_panel;
+    colors = new Uint32Array(colors);
+    const panel = context.panel(1, colors.length);
+    mix.indexed_colors = quad.indexed_colors = colors;
+    mix.color_panel = panel;
+    mix.colors_promise = panel.push_buffer(colors);
+    function recolor(owner, name, sequence, target) {
+        const old = owner[name];
+        const action = new old.constructor(panel, target, old.default_color);
+        action.attach_to_context(context);
+        sequence.actions[sequence.actions.indexOf(old)] = action;
+        owner[name] = action;
+        old.parameters.gpu_buffer.destroy();
+    }
+    recolor(mix, "index_colorize", mix.project_to_panel, mix.index_panel);
+    recolor(quad, "indexed_colorize", quad.project_to_panel, quad.segmentation_value_panel);
+    old_panel.gpu_buffer.destroy();
+    mix.colors_promise.then(function () { quad.run(); });
+    return colors.length;
+"""
+
+# Least number of label colors allocated (more are added as labels are added).
+MIN_COLORS = 256
+
+def label_colors(max_label):
+    """
+    Background then distinct colors for labels up to max_label (not repeating for large label counts),
+    with room for more labels: the length is a power of two of at least MIN_COLORS.
+    """
+    length = MIN_COLORS
+    while length <= max_label:
+        length *= 2
+    return np.concatenate([[0], color_list.get_color_array(length - 1, distinct=True)]).astype(np.uint32)
 
 class SegmentationQuad(VolumeSuper.VolumeGizmo):
 
-    def __init__(self, labels, intensities, size=512, dI=1, dJ=1, dK=1, rotate=True, nlabels=None):
-        assert labels.max() < 256 and labels.min() >= 0, "Labels must be 8-bit."
+    def __init__(self, labels, intensities, size=512, dI=1, dJ=1, dK=1, rotate=True, nlabels=None, scale=True, compress=False, delta=False, progressive=False,
+            max_rate=coalesce.DEFAULT_MAX_RATE):
+        # Labels may be any integers: they are compacted to uint8 or uint16 if necessary (see label_at).
+        # If scale is False the intensities must already be scaled to bytes.
+        # If compress is set transfer run length encoded labels and deflated intensities.
+        # If delta is set changed volumes are sent as changed blocks (keeps full copies of the volumes in memory).
+        # If progressive is set paint coarse proxies first, then swap in the full resolution volumes.
+        # max_rate is the maximum number of view updates per second while dragging the depth slider.
+        self.max_rate = max_rate
+        self.delta = delta
+        self.progressive = progressive
+        self.label_codec = self.intensity_codec = None
+        if compress:
+            self.label_codec = transfer.RLE
+            self.intensity_codec = transfer.DEFLATE
         self.orbiting = rotate
-        self.labels = labels.astype(np.ubyte)
-        self.intensities = loaders.scale_to_bytes(intensities)
+        # conversion buffers reused by change_volumes
+        self.label_buffer = self.intensity_buffer = None
+        # original label ids of the compacted labels, or None if the labels are not compacted
+        self.label_ids = None
+        self.colors = None
+        self.quad = None
+        self.labels = self.compact_labels(labels)
+        if scale:
+            self.intensities = self.intensity_bytes(intensities)
+        else:
+            assert intensities.dtype == np.uint8, "unscaled intensities must be bytes."
+            self.intensities = intensities
         self.cpu_seg = None
         self.cpu_int = None
         if nlabels is None:
-            nlabels = self.labels.max()
-        hex_colors = [0] + list(color_list.get_hex_colors(nlabels))
-        #print("hex_colors", list(map(hex, hex_colors)))
-        self.colors = np.array(hex_colors, dtype=np.uint32)
+            nlabels = statistics.volume_statistics(self.labels).maximum
+        self.colors = label_colors(nlabels)
         self.size = size
         dash = self.make_dashboard()
         self.configure_dashboard(dash)
@@ -26,11 +88,68 @@ class SegmentationQuad(VolumeSuper.VolumeGizmo):
         self.dK = dK
 
     async def change_volumes(self, labels=None, intensities=None):
+        # the arrays may have been edited in place since their statistics were cached.
         if labels is not None:
-            self.labels = labels.astype(np.ubyte)
+            statistics.invalidate(labels)
+            labels = self.compact_labels(labels)
         if intensities is not None:
-            self.intensities = loaders.scale_to_bytes(intensities)
+            statistics.invalidate(intensities)
+            intensities = self.intensity_bytes(intensities)
         await self.load_volumes(reload=True, labels=labels, intensities=intensities)
+        if labels is not None:
+            self.grow_colors(statistics.volume_statistics(labels).maximum)
+            self.seg_slice_text.text(self.label_summary())
+
+    def grow_colors(self, max_label):
+        "Extend the label colors (in the view too) if labels up to max_label don't all have one."
+        if max_label < len(self.colors):
+            return
+        self.colors = label_colors(max_label)
+        if self.quad is not None:
+            regrow = self.js_function(self.dash, "change_label_colors", CHANGE_COLORS_ARGUMENTS, CHANGE_COLORS_BODY)
+            do(regrow(self.quad, self.colors))
+
+    def compact_labels(self, labels):
+        """
+        The labels in an unsigned dtype, compacted into a reused buffer if they don't fit 16 bits
+        (keeping the original ids in label_ids) and otherwise unchanged if possible.
+        Labels already shown keep their numbers (and colors); new labels are numbered after them.
+        """
+        if self.label_buffer is not None:
+            statistics.invalidate(self.label_buffer)
+        original_ids = self.label_ids
+        if original_ids is None and self.colors is not None:
+            # labels shown with their own ids so far keep them if new labels need compacting.
+            original_ids = np.arange(len(self.colors))
+        (compact, self.label_ids) = relabel.compact_labels(labels, out=self.label_buffer, original_ids=original_ids)
+        if compact is not labels:
+            self.label_buffer = compact
+            self.note_copy("labels")
+        return compact
+
+    def label_at(self, k, j, i):
+        "The original label id at voxel (k, j, i)."
+        return relabel.original_label(self.label_ids, self.labels[k, j, i])
+
+    def label_summary(self):
+        "Text describing the labels shown, by their original ids."
+        ids = relabel.present_labels(self.labels)
+        if self.label_ids is not None:
+            ids = self.label_ids[ids]
+        ids = ids[ids != 0]
+        if len(ids) == 0:
+            return "Segmentation Slice: no labels"
+        return "Segmentation Slice: %d labels (ids %s to %s)" % (len(ids), ids.min(), ids.max())
+
+    def intensity_bytes(self, intensities):
+        "The intensities scaled to bytes in a reused buffer."
+        if self.intensity_buffer is None or self.intensity_buffer.shape != intensities.shape:
+            self.intensity_buffer = None
+        self.note_copy("scale_to_bytes")
+        if self.intensity_buffer is not None:
+            statistics.invalidate(self.intensity_buffer)
+        self.intensity_buffer = loaders.scale_to_bytes(intensities, out=self.intensity_buffer)
+        return self.intensity_buffer
 
     def make_dashboard(self):
         size = self.size
@@ -38,13 +157,15 @@ class SegmentationQuad(VolumeSuper.VolumeGizmo):
         self.seg_shade_canvas = self.canvas_component("seg_shade_canvas", size, size)
         self.int_slice_canvas = self.canvas_component("int_slice_canvas", size, size)
         self.max_int_canvas = self.canvas_component("max_int_canvas", size, size)
-        self.seg_slice_text = Text("Segmentation Slice")
+        self.seg_slice_text = Text(self.label_summary())
         self.seg_shade_text = Text("Segmentation Shaded")
         self.int_slice_text = Text("Intensity Slice")
         self.max_int_text = Text("Max Intensity")
         self.depth_text = Text("Depth")
         step = 1
-        self.depth_slider = Slider(minimum=0, maximum=255, step=step, value=128, on_change=self.depth_slide)
+        # slider events are coalesced here rather than delayed by the slider.
+        self.depth_slider = Slider(minimum=0, maximum=255, step=step, value=128, on_change=self.depth_slide, delay=0)
+        self.depth_changes = coalesce.Coalescer(self.change_depth, self.max_rate)
         self.dash = Stack([
             [
                 [self.seg_slice_canvas, self.seg_slice_text],
@@ -75,18 +196,35 @@ class SegmentationQuad(VolumeSuper.VolumeGizmo):
         web_gpu_volume = self.web_gpu_volume
         context = self.context
         dash = self.dash
+        load = self.async_load_array_to_js
+        if reload and self.delta:
+            load = self.async_update_array_to_js
+        progressive = self.progressive and not reload
         if labels is not None:
             self.labels = labels
-            self.cpu_seg = await self.async_load_array_to_js(self.labels, dash, name="cpu_seg")
+            if progressive:
+                # labels are sampled rather than averaged.
+                self.cpu_seg = await self.async_load_proxy_to_js(self.labels, dash, name="cpu_seg", method="subsample")
+            else:
+                self.cpu_seg = await load(self.labels, dash, name="cpu_seg", codec=self.label_codec, remember=self.delta)
         if intensities is not None:
             self.intensities = intensities
-            self.cpu_int = await self.async_load_array_to_js(self.intensities, dash, name="cpu_int")
+            if progressive:
+                self.cpu_int = await self.async_load_proxy_to_js(self.intensities, dash, name="cpu_int")
+            else:
+                self.cpu_int = await load(self.intensities, dash, name="cpu_int", codec=self.intensity_codec, remember=self.delta)
         #cpu_colors = self.load_array_to_js(self.colors, dash, name="cpu_colors")
         #gpu_colors = dash.cache("gpu_colors", cpu_colors.gpu_volume(context, dK, dJ, dI))
         if not reload:
             [dK, dJ, dI] = [self.dK, self.dJ, self.dI]
+            start = time.perf_counter()
             gpu_seg = dash.cache("gpu_seg", self.cpu_seg.gpu_volume(context, dK, dJ, dI))
             gpu_int = dash.cache("gpu_int", self.cpu_int.gpu_volume(context, dK, dJ, dI))
+            await self.async_profile_gpu("gpu upload", start, 4 * (profiling.array_size(self.labels) + profiling.array_size(self.intensities)))
+            if progressive:
+                self.set_value_range(dash, gpu_seg, self.labels)
+                self.set_value_range(dash, gpu_int, self.intensities)
+            start = time.perf_counter()
             view_init = dash.new(
                 web_gpu_volume.SegmentationQuad.SegmentationQuad, 
                 gpu_seg, 
@@ -104,17 +242,27 @@ class SegmentationQuad(VolumeSuper.VolumeGizmo):
                 self.seg_shade_canvas.element[0], 
                 orbiting
             ))
+            await self.async_profile_gpu("first frame", start)
+            if progressive:
+                self.depth_text.text("preview: loading full resolution...")
+                self.cpu_seg = await self.async_swap_full_volume(self.labels, dash, gpu_seg, self.quad,
+                    name="cpu_seg", codec=self.label_codec, remember=self.delta)
+                self.cpu_int = await self.async_swap_full_volume(self.intensities, dash, gpu_int, self.quad,
+                    name="cpu_int", codec=self.intensity_codec, remember=self.delta)
         else:
             assert self.cpu_seg is not None and self.cpu_int is not None, "must have loaded volumes before reloading"
             do(self.quad.change_volumes(self.cpu_seg, self.cpu_int))
         self.depth_text.text("loaded async.")
 
     def depth_slide(self, *ignored):
-        value = self.depth_slider.value
+        self.depth_changes(self.depth_slider.value)
+
+    async def change_depth(self, value):
         # reverse orientation
         depth = self.depth_max - value
         do(self.quad.change_depth(depth))
         self.depth_text.text(f"Depth: {depth}")
+        await self.async_work_done()
 
     def range_callback(self, min_value, max_value):
         step = 1
@@ -134,12 +282,13 @@ async def quad(
         dI=1,
         dJ=1,
         dK=1,
-        rotate=True):
+        rotate=True,
+        lazy=False):
     "Load a segmentation quad from files."
     def get_array(path):
         expanded_path = os.path.expanduser(path)
         #print("loading volume", expanded_path)
-        return loaders.load_volume(expanded_path)
+        return loaders.load_volume(expanded_path, lazy=lazy)
     labels = get_array(labels_path)
     intensities = get_array(intensities_path)
     quad = SegmentationQuad(
@@ -162,30 +311,66 @@ def script(debug=True):
     parser.add_argument('--seg', type=str, help='File path to the segmentation', required=True)
     parser.add_argument('--int', type=str, help='File path to the intensities', required=True)
     parser.add_argument('--size', type=int, help='canvas size', default=512)
-    parser.add_argument('--dI', type=float, help='dI', default=1)
-    parser.add_argument('--dJ', type=float, help='dJ', default=1)
-    parser.add_argument('--dK', type=float, help='dK', default=1)
+    parser.add_argument('--dI', type=float, help='dI (default from file header or 1)', default=None)
+    parser.add_argument('--dJ', type=float, help='dJ (default from file header or 1)', default=None)
+    parser.add_argument('--dK', type=float, help='dK (default from file header or 1)', default=None)
     parser.add_argument('--no-rotate', dest='rotate', action='store_false', help='stop rotation')
+    parser.add_argument('--compress', action='store_true', help='compress the volumes for transfer')
+    parser.add_argument('--profile', action='store_true', help='print the time spent in each loading stage')
+    parser.add_argument('--progressive', action='store_true', help='show coarse previews while loading the full volumes')
+    loaders.add_arguments(parser)
+    volume_cache.add_arguments(parser)
 
     args = parser.parse_args()
+    if args.profile:
+        profiling.enable()
     expanded_int = os.path.expanduser(args.int)
     expanded_seg = os.path.expanduser(args.seg)
     if debug:
         print("int path:", expanded_int)
         print("seg path:", expanded_seg)
         print("size:", args.size)
-    print("loading intensity volume")
-    ar_int = loaders.load_volume(expanded_int)
-    print("loading segmentation volume")
-    ar_seg = loaders.load_volume(expanded_seg)
+    options = loaders.arguments_options(args)
+    reduction = loaders.arguments_reduction(args)
+    reduce = reduction["max_voxels"] is not None or reduction["downsample"] is not None
+    cache = volume_cache.from_arguments(args)
+    # memory map where possible: both volumes are converted to bytes in one pass.
+    def load_intensities():
+        print("loading intensity volume")
+        ar_int = loaders.load_volume(expanded_int, lazy=True, **options)
+        print("loaded intensities", ar_int.shape, ar_int.dtype)
+        factors = [1, 1, 1]
+        if reduce:
+            (ar_int, factors) = loaders.reduce_volume(ar_int, **reduction)
+        return (loaders.scale_to_bytes(ar_int), dict(factors=factors))
+    parameters = dict(conversion="scale_to_bytes", options=options, reduction=reduction)
+    (ar_int, info) = volume_cache.cached_or_computed(cache, expanded_int, parameters, load_intensities)
+    factors = info["factors"]
+    def load_segmentation():
+        print("loading segmentation volume")
+        ar_seg = loaders.load_volume(expanded_seg, lazy=True, **options)
+        print("loaded segmentation", ar_seg.shape, ar_seg.dtype)
+        if reduce:
+            # average the intensities but sample the labels, using the same factors for both.
+            ar_seg = loaders.block_reduce(ar_seg, factors, method="subsample")
+        return (np.asarray(ar_seg), dict(factors=factors))
+    parameters = dict(conversion="labels", options=options, factors=factors)
+    (ar_seg, info) = volume_cache.cached_or_computed(cache, expanded_seg, parameters, load_segmentation)
     print("loaded volumes", ar_int.shape, ar_seg.shape, ar_int.dtype, ar_seg.dtype)
+    (dK, dJ, dI) = loaders.arguments_spacing(args, expanded_int)
+    (dK, dJ, dI) = (dK * factors[0], dJ * factors[1], dI * factors[2])
+    if reduce:
+        print("downsampled by", factors, "to", ar_int.shape, "voxel dimensions (dK, dJ, dI):", (dK, dJ, dI))
     #print("rotating", args.rotate)
     quad = SegmentationQuad(
         labels=ar_seg, 
         intensities=ar_int, 
         size=args.size,
-        dI=args.dI,
-        dJ=args.dJ,
-        dK=args.dK,
-        rotate=args.rotate)
-    serve(quad.link())
+        dI=dI,
+        dJ=dJ,
+        dK=dK,
+        rotate=args.rotate,
+        scale=False,
+        compress=args.compress,
+        progressive=args.progressive)
+    serve(profiling.link_and_report(quad))
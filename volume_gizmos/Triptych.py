@@ -1,12 +1,34 @@
 
+import numpy as np
 from H5Gizmos import Html, serve, get, do, Stack, Slider, Text, ClickableText
-from . import VolumeSuper, loaders
+from . import VolumeSuper, loaders, volume_cache, transfer, profiling, bricks, coalesce, statistics
 import os
+import time
 
 class Triptych(VolumeSuper.VolumeGizmo):
 
-    def __init__(self, array, dK=1, dJ=1, dI=1, size=512, orbiting=True, name="Triptych"):
+    def __init__(self, array, dK=1, dJ=1, dI=1, size=512, orbiting=True, name="Triptych", codec=None, slab_bytes=None, delta=False, quantize=None, progressive=False,
+            max_gpu_bytes=None, max_rate=coalesce.DEFAULT_MAX_RATE):
+        # codec: optional compressed transfer encoding ("deflate" or "rle")
+        # progressive: paint a coarse proxy first, then swap in the full resolution volume
+        # quantize: 8 or 16 to quantize values to that many bits for transfer if they can't be sent exactly
+        # slab_bytes: if set upload the volume in slabs of about this size with progress reports
+        # delta: if set reloads send only the changed blocks (keeps a full copy of the volume in memory)
+        # max_gpu_bytes: if set larger volumes are split into bricks shown one at a time
+        # max_rate: maximum number of view updates per second while dragging a slider
         self.array = array
+        self.max_rate = max_rate
+        self.max_gpu_bytes = max_gpu_bytes
+        self.quantize = quantize
+        self.narrowing = None
+        self.narrow_buffer = None
+        self.progressive = progressive
+        # transferred values are (value - offset) / scale
+        self.scale = 1.0
+        self.offset = 0.0
+        self.delta = delta
+        self.codec = codec
+        self.slab_bytes = slab_bytes
         self.dK = dK
         self.dJ = dJ
         self.dI = dI
@@ -14,6 +36,7 @@ class Triptych(VolumeSuper.VolumeGizmo):
         self.name = name
         self.orbiting = orbiting
         self.triptych = None # set in load_volume_async
+        self.gpu_volume = None
         dash = self.make_dashboard()
         self.configure_dashboard(dash)
 
@@ -34,9 +57,23 @@ class Triptych(VolumeSuper.VolumeGizmo):
         context = self.context
         dash = self.dash
         #cpu_volume = self.load_array_to_js(self.array, dash)
-        cpu_volume = await self.async_load_array_to_js(self.array, dash)
+        narrow = self.narrowed_array()
+        options = self.transfer_options()
+        if self.progressive:
+            cpu_volume = await self.async_load_proxy_to_js(narrow, dash)
+        else:
+            cpu_volume = await self.async_load_array_to_js(narrow, dash, **options)
         [dK, dJ, dI] = [self.dK, self.dJ, self.dI]
+        start = time.perf_counter()
         gpu_volume = dash.cache("gpu_volume", cpu_volume.gpu_volume(context, dK, dJ, dI))
+        self.gpu_volume = gpu_volume
+        await self.async_profile_gpu("gpu upload", start, 4 * profiling.array_size(narrow))
+        if self.brick_list is not None:
+            # views use the value range of the whole volume for every brick.
+            self.set_value_range(dash, gpu_volume, value_range=self.transfer_value_range())
+        elif self.progressive:
+            self.set_value_range(dash, gpu_volume, narrow)
+        start = time.perf_counter()
         view_init = dash.new(web_gpu_volume.Triptych.Triptych, gpu_volume, self.range_callback)
         orbiting = True
         self.triptych = dash.cache("triptych", view_init)
@@ -46,6 +83,14 @@ class Triptych(VolumeSuper.VolumeGizmo):
             self.slice_canvas.element[0], 
             orbiting)
         )
+        # the view starts at the middle value: show the slider's starting level instead.
+        level = self.level_slider.value
+        do(self.triptych.change_threshold(self.transfer_value(level)))
+        self.level_text.text("Level: " + str(level))
+        await self.async_profile_gpu("first frame", start)
+        if self.progressive:
+            self.set_status(repr(self.name) + " preview: loading full resolution...")
+            await self.async_swap_full_volume(narrow, dash, gpu_volume, self.triptych, **options)
         self.set_status(repr(self.name) + " loaded async.")
 
     async def reload_volume_async(self, array):
@@ -53,33 +98,55 @@ class Triptych(VolumeSuper.VolumeGizmo):
         assert array.shape == self.array.shape, "new array shape must match original" + repr(array.shape) + " != " + repr(self.array.shape)
         assert array.dtype == self.array.dtype, "new array dtype must match original" + repr(array.dtype) + " != " + repr(self.array.dtype)
         self.array = array
-        mn = float(self.array.min())
-        mx = float(self.array.max())
+        self.narrowing = None
+        # the array may have been changed in place.
+        statistics.invalidate(array)
+        stats = statistics.volume_statistics(array)
+        (mn, mx) = (float(stats.minimum), float(stats.maximum))
+        (self.value_min, self.value_max) = (mn, mx)
         #print("Reloading volume... " + repr(self.array.shape) + repr([mn, mx]))
         #self.set_status("Reloading volume... " + repr(self.array.shape) + repr([mn, mx]))
         dash = self.dash
-        cpu_volume = await self.async_load_array_to_js(self.array, dash, name="cpu_volume")
-        do(self.triptych.change_volume(cpu_volume.data))
-        self.level_slider.set_range(minimum=mn, maximum=mx)
+        options = self.transfer_options()
+        del options["remember"]
+        if self.delta:
+            cpu_volume = await self.async_update_array_to_js(self.narrowed_array(), dash, name="cpu_volume", **options)
+        else:
+            cpu_volume = await self.async_load_array_to_js(self.narrowed_array(), dash, name="cpu_volume", **options)
+        # push the new data into the GPU volume and rerun the view (as for a brick swap).
+        swap = self.js_function(dash, "swap_volume", transfer.SWAP_ARGUMENTS, transfer.SWAP_BODY)
+        await get(swap(self.gpu_volume, cpu_volume.data, self.triptych))
+        self.level_slider.set_range(minimum=mn, maximum=max(mx, mn + 1), step=stats.step())
+        # the narrowing may have changed: send the slider level in the units of the new volume.
+        level = min(max(self.level_slider.value, mn), max(mx, mn + 1))
+        self.level_slider.set_value(level)
+        do(self.triptych.change_threshold(self.transfer_value(level)))
 
     def make_dashboard(self):
         size = self.size
         self.iso_canvas = self.canvas_component("iso-canvas", size, size)
         #self.iso_canvas = Html('<canvas id="iso-canvas" width="512" height="512"></canvas>')
         self.level_text = Text("Level")
-        mn = float(self.array.min())
-        mx = float(self.array.max())
-        md = (mn + mx) / 2
+        stats = statistics.volume_statistics(self.array)
+        mn = float(stats.minimum)
+        mx = float(stats.maximum)
+        self.value_min = mn
+        self.value_max = mx
+        # start at the level separating the two main value classes rather than the midpoint.
+        md = float(stats.otsu_level())
         step = 1
         if mx - mn > 1e-6:
-            step = (mx - mn) / 255
+            step = stats.step()
         else:
             mx = mn + 1
-        self.level_slider = Slider(minimum=mn, maximum=mx, step=step, value=md, on_change=self.threshold_slide)
+        # slider events are coalesced here rather than delayed by the slider.
+        self.level_slider = Slider(minimum=mn, maximum=mx, step=step, value=md, on_change=self.threshold_slide, delay=0)
+        self.level_changes = coalesce.Coalescer(self.change_level, self.max_rate)
         self.max_canvas = self.canvas_component("max-canvas", size, size)
         self.status_text = Text("Status")
         self.depth_text = Text("Depth")
-        self.depth_slider = Slider(minimum=0, maximum=255, step=1, value=128, on_change=self.depth_slide)
+        self.depth_slider = Slider(minimum=0, maximum=255, step=1, value=128, on_change=self.depth_slide, delay=0)
+        self.depth_changes = coalesce.Coalescer(self.change_depth, self.max_rate)
         self.slice_canvas = self.canvas_component("slice-canvas", size, size)
         self.colorize = ClickableText("Colorize", on_click=self.colorize_click)
         self.colorize.css(color="blue")
@@ -90,12 +157,50 @@ class Triptych(VolumeSuper.VolumeGizmo):
                 [self.max_canvas, self.colorize, self.status_text], 
                 [self.slice_canvas, self.depth_text, self.depth_slider],
             ],
-        ])
+        ] + self.setup_bricks(self.array.shape, self.max_gpu_bytes))
         return self.dash
     
     def set_status(self, text):
         self.status_text.text(text)
 
+    def narrowed_array(self):
+        """
+        The (current brick of the) array in its narrowest transfer representation,
+        setting the scale and offset of the transferred values.
+        """
+        brick = self.brick(self.array)
+        with profiling.stage("convert", profiling.array_bytes(brick)):
+            if self.narrowing is None:
+                # choose the representation for the whole array so all bricks match.
+                self.narrowing = transfer.narrowing(self.array, self.quantize)
+            (dtype, self.scale, self.offset) = self.narrowing
+            narrow = transfer.apply_narrowing(brick, self.narrowing, out=self.narrow_buffer)
+        if narrow is not brick:
+            # reuse the conversion buffer for the next brick or reload.
+            self.narrow_buffer = narrow
+            statistics.invalidate(narrow)
+            self.note_copy("narrow")
+        return narrow
+
+    def transfer_value_range(self):
+        "The value range of the whole array in the units of the transferred volume."
+        return (self.transfer_value(self.value_min), self.transfer_value(self.value_max))
+
+    def transfer_options(self):
+        "Options for async_load_array_to_js."
+        progress = self.progress_reporter(self.set_status, repr(self.name))
+        return dict(codec=self.codec, slab_bytes=self.slab_bytes, progress=progress, remember=self.delta)
+
+    async def show_brick_async(self):
+        self.set_status("Loading " + self.brick_description())
+        await self.async_swap_full_volume(self.narrowed_array(), self.dash, self.gpu_volume, self.triptych,
+            name="cpu_volume", **self.transfer_options())
+        self.set_status(repr(self.name) + " " + self.brick_description())
+
+    def transfer_value(self, value):
+        "Convert a value in the original units to the units of the transferred volume."
+        return (value - self.offset) / self.scale
+
     def colorize_click(self, *ignored):
         self.colorized = not self.colorized
         do(self.triptych.set_colorize(self.colorized))
@@ -108,19 +213,25 @@ class Triptych(VolumeSuper.VolumeGizmo):
         self.depth_slider.set_range(minimum=min_value, maximum=max_value)
     
     def threshold_slide(self, *ignored):
-        level = self.level_slider.value
-        do(self.triptych.change_threshold(level))
+        self.level_changes(self.level_slider.value)
+
+    async def change_level(self, level):
+        do(self.triptych.change_threshold(self.transfer_value(level)))
         self.level_text.text("Level: " + str(level))
+        await self.async_work_done()
 
     def depth_slide(self, *ignored):
-        depth = self.depth_slider.value
+        self.depth_changes(self.depth_slider.value)
+
+    async def change_depth(self, depth):
         do(self.triptych.change_depth(depth))
         self.depth_text.text("Depth: " + str(depth))
+        await self.async_work_done()
 
-async def panels(volume_path, dK=1.0, dJ=1.0, dI=1.0, size=512, show=True):
+async def panels(volume_path, dK=1.0, dJ=1.0, dI=1.0, size=512, show=True, lazy=False):
     expanded_volume = os.path.expanduser(volume_path)
     print("Loading volume", repr(volume_path))
-    array = loaders.load_volume(expanded_volume)
+    array = loaders.load_volume(expanded_volume, lazy=lazy)
     print("loaded", array.shape, array.dtype)
     name = os.path.split(expanded_volume)[-1]
     triptych = Triptych(array, dK, dJ, dI, size, name=name)
@@ -139,27 +250,61 @@ def script(debug=True):
     parser.add_argument('--volume', type=str, help='File path to the volume', required=True)
 
     # Add the three float arguments
-    parser.add_argument('--dI', type=float, help='voxel width', default=1.0)
-    parser.add_argument('--dJ', type=float, help='voxel height', default=1.0)
-    parser.add_argument('--dK', type=float, help='voxel depth', default=1.0)
+    parser.add_argument('--dI', type=float, help='voxel width (default from file header or 1)', default=None)
+    parser.add_argument('--dJ', type=float, help='voxel height (default from file header or 1)', default=None)
+    parser.add_argument('--dK', type=float, help='voxel depth (default from file header or 1)', default=None)
     parser.add_argument('--size', type=int, help='canvas size', default=512)
+    parser.add_argument('--compress', action='store_true', help='compress the volume for transfer')
+    parser.add_argument('--quantize', type=int, choices=[8, 16], help='quantize non-integer volumes to 8 or 16 bits for transfer', default=None)
+    parser.add_argument('--progressive', action='store_true', help='show a coarse preview while loading the full volume')
+    parser.add_argument('--profile', action='store_true', help='print the time spent in each loading stage')
+    parser.add_argument('--max-gpu-mb', dest='max_gpu_mb', type=float, help='split larger volumes into bricks (128 fits any WebGPU device; by default volumes are not split)', default=None)
+    parser.add_argument('--slab-mb', dest='slab_mb', type=float, help='upload the volume in slabs of this many megabytes', default=None)
+    loaders.add_arguments(parser)
+    volume_cache.add_arguments(parser)
 
     # Parse the arguments from the command line
     args = parser.parse_args()
+    if args.profile:
+        profiling.enable()
 
     expanded_volume = os.path.expanduser(args.volume)
+    (dK, dJ, dI) = loaders.arguments_spacing(args, expanded_volume)
     if debug:
         print("File path:", expanded_volume)
-        print("width (dI):", args.dI)
-        print("height (dJ):", args.dJ)
-        print("depth (dK):", args.dK)
+        print("width (dI):", dI)
+        print("height (dJ):", dJ)
+        print("depth (dK):", dK)
         print("canvas size:", args.size)
 
-    print("Loading volume", repr(args.volume))
-    array = loaders.load_volume(expanded_volume)
-    print("loaded", array.shape, array.dtype)
-    arrayf32 = array.astype('float32')
+    options = loaders.arguments_options(args)
+    reduction = loaders.arguments_reduction(args)
+    def load_and_convert():
+        print("Loading volume", repr(args.volume))
+        # memory map where possible: keep the native dtype, narrowed for transfer by the gizmo.
+        array = loaders.load_volume(expanded_volume, lazy=True, **options)
+        print("loaded", array.shape, array.dtype)
+        factors = [1, 1, 1]
+        if reduction["max_voxels"] is not None or reduction["downsample"] is not None:
+            (array, factors) = loaders.reduce_volume(array, **reduction)
+        return (np.asarray(array), dict(factors=factors))
+    cache = volume_cache.from_arguments(args)
+    parameters = dict(conversion="native", options=options, reduction=reduction)
+    (array, info) = volume_cache.cached_or_computed(cache, expanded_volume, parameters, load_and_convert)
+    factors = info["factors"]
+    # keep the rendered geometry: reduced voxels are larger.
+    (dK, dJ, dI) = (dK * factors[0], dJ * factors[1], dI * factors[2])
+    if factors != [1, 1, 1]:
+        print("downsampled by", factors, "to", array.shape, "voxel dimensions (dK, dJ, dI):", (dK, dJ, dI))
     name = os.path.split(expanded_volume)[-1]
-    #arrayf32 = arrayf32[::5, ::5, ::5]
-    triptych = Triptych(arrayf32, args.dK, args.dJ, args.dI, args.size, name=name)
-    serve(triptych.link())
+    codec = None
+    if args.compress:
+        codec = transfer.DEFLATE
+    max_gpu_bytes = None
+    if args.max_gpu_mb is not None:
+        max_gpu_bytes = int(args.max_gpu_mb * 1024 ** 2)
+    slab_bytes = None
+    if args.slab_mb is not None:
+        slab_bytes = int(args.slab_mb * 1024 ** 2)
+    triptych = Triptych(array, dK, dJ, dI, args.size, name=name, codec=codec, slab_bytes=slab_bytes, quantize=args.quantize, progressive=args.progressive, max_gpu_bytes=max_gpu_bytes)
+    serve(profiling.link_and_report(triptych))
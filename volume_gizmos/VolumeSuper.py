@@ -1,7 +1,13 @@
 
 
 import importlib.resources
-from H5Gizmos import do, Html, js_await
+import time
+import numpy as np
+from H5Gizmos import do, get, Html, js_await, Text, Slider, schedule_task
+from . import transfer, loaders, volume_registry, profiling, bricks, statistics
+
+# Voxel budget of the coarse proxy volume for progressive loading.
+PROXY_VOXELS = 64 ** 3
 
 class VolumeGizmo:
     """Base class for volume gizmos"""
@@ -43,17 +49,339 @@ class VolumeGizmo:
         # component.store_array in 
         # https://github.com/AaronWatters/H5Gizmos/blob/main/doc/Javascript/README.md
         web_gpu_volume = self.web_gpu_volume
-        init_volume = dash.new(web_gpu_volume.CPUVolume.Volume, array.shape, array.ravel())
+        flat = transfer.transfer_ready(array, self.note_copy).reshape(-1)
+        init_volume = dash.new(web_gpu_volume.CPUVolume.Volume, array.shape, flat)
         cpu_volume = dash.cache(name, init_volume )
         return cpu_volume
     
-    async def async_load_array_to_js(self, array, dash, name="cpu_volume"):
+    async def async_load_array_to_js(self, array, dash, name="cpu_volume", codec=None, slab_bytes=None, progress=None, remember=False, share=True):
+        # If remember is set keep a copy of the array for later delta updates (async_update_array_to_js).
+        # If share is set an identical array already sent to the page (by any gizmo) is referenced instead of sent again.
+        if remember:
+            self.remember_array(name, array)
+        nbytes = profiling.array_bytes(array)
+        if not share:
+            self.release_shared_volume(dash, name)
+            with profiling.stage("transfer", nbytes):
+                return await self.async_upload_volume(array, dash, name, codec, slab_bytes, progress)
+        with profiling.stage("hash", nbytes):
+            key = volume_registry.content_key(array)
+        registry = volume_registry.registry_for(dash.gizmo)
+        shared = self.shared_cache(dash)
+        shared_name = registry.acquire(key)
+        if shared_name is None:
+            shared_name = volume_registry.shared_name(key)
+            with profiling.stage("transfer", nbytes):
+                await self.async_upload_volume(array, dash, shared_name, codec, slab_bytes, progress)
+            # move the volume from this component's cache to the page's shared volumes.
+            do(shared._set(shared_name, dash.my(shared_name)))
+            dash.uncache(shared_name + "_buffer")
+            dash.uncache(shared_name)
+            registry.add(key, shared_name)
+        else:
+            do(dash.window.console.log("using shared volume", shared_name))
+        # release the previous volume after acquiring, so reloading the same content keeps it.
+        self.release_shared_volume(dash, name)
+        self.shared_volume_keys()[name] = key
+        return dash.cache(name, shared[shared_name])
+
+    async def async_upload_volume(self, array, dash, name, codec=None, slab_bytes=None, progress=None):
+        "Transfer the array and cache a Javascript CPU volume for it as name."
         buffer_name = name + "_buffer"
         #buffer_reference = dash.cache(buffer_name, array.ravel())
-        buffer_reference = await dash.store_array(array, buffer_name)
+        if slab_bytes is not None:
+            if codec is not None:
+                raise ValueError("Slab streaming does not support transfer codec: " + repr(codec))
+            buffer_reference = await self.async_stream_buffer(array, dash, buffer_name, slab_bytes, progress)
+        else:
+            buffer_reference = await self.async_store_buffer(array, dash, buffer_name, codec)
         do(dash.window.console.log("transferred array asynchronously", buffer_reference))
         web_gpu_volume = self.web_gpu_volume
         #init_volume = dash.new(web_gpu_volume.CPUVolume.Volume, array.shape, array.ravel())
         init_volume = dash.new(web_gpu_volume.CPUVolume.Volume, array.shape, buffer_reference)
         cpu_volume = dash.cache(name, init_volume )
         return cpu_volume
+
+    def shared_volume_keys(self):
+        "Content keys of the shared volumes used by this gizmo, by cache name."
+        keys = getattr(self, "shared_keys", None)
+        if keys is None:
+            keys = self.shared_keys = {}
+        return keys
+
+    def shared_cache(self, dash):
+        """
+        Reference to the Javascript object holding the volumes shared by the gizmos on the page.
+        Each H5Gizmos component has its own object cache, so the shared volumes are kept in one
+        object created by the first gizmo on the page and aliased into each gizmo's cache.
+        """
+        registry = volume_registry.registry_for(dash.gizmo)
+        if registry.cache is None:
+            registry.cache = dash.cache(volume_registry.CACHE_NAME, dash.new(dash.window.Object))
+        return registry.cache
+
+    def drop_shared_volume(self, dash, shared_name):
+        "Remove a volume from the page's shared volumes (gizmos aliasing it keep it)."
+        do(dash.window.Reflect.deleteProperty(self.shared_cache(dash), shared_name))
+
+    def release_shared_volume(self, dash, name):
+        "Drop this gizmo's reference to the shared volume cached as name, freeing it if no gizmo uses it."
+        key = self.shared_volume_keys().pop(name, None)
+        if key is None:
+            return
+        shared_name = volume_registry.registry_for(dash.gizmo).release(key)
+        if shared_name is not None:
+            self.drop_shared_volume(dash, shared_name)
+
+    def release_volumes(self, dash):
+        "Release all the shared volumes used by this gizmo (when it is discarded)."
+        for name in list(self.shared_volume_keys()):
+            self.release_shared_volume(dash, name)
+            dash.uncache(name)
+
+    async def async_load_proxy_to_js(self, array, dash, name="cpu_volume", method="mean", max_voxels=PROXY_VOXELS):
+        """
+        Load a downsampled proxy of the array expanded in Javascript to a volume of the full shape,
+        so views can be built and painted before the full data arrives (see async_swap_full_volume).
+        Use method="subsample" for label volumes.
+        """
+        factors = loaders.downsample_factors(array.shape, max_voxels)
+        proxy = loaders.block_reduce(array, factors, method=method)
+        proxy_name = name + "_proxy"
+        proxy_reference = await transfer.store_array(dash, proxy, proxy_name)
+        upsample = self.js_function(dash, "upsample", transfer.UPSAMPLE_ARGUMENTS, transfer.UPSAMPLE_BODY)
+        shape = [int(n) for n in array.shape]
+        proxy_shape = [int(n) for n in proxy.shape]
+        buffer_reference = dash.cache(name + "_buffer", upsample(proxy_reference, proxy_shape, shape, factors))
+        dash.uncache(proxy_name)
+        init_volume = dash.new(self.web_gpu_volume.CPUVolume.Volume, array.shape, buffer_reference)
+        return dash.cache(name, init_volume)
+
+    def set_value_range(self, dash, gpu_volume, array=None, value_range=None):
+        """
+        Give a GPU volume built from a proxy or brick the value range of the full array
+        or the given (min, max) value range, before building views on it.
+        """
+        if value_range is None:
+            value_range = statistics.volume_statistics(array).value_range
+        (mn, mx) = value_range
+        assign = self.js_function(dash, "set_value_range", transfer.VALUE_RANGE_ARGUMENTS, transfer.VALUE_RANGE_BODY)
+        do(assign(gpu_volume, float(mn), float(mx)))
+
+    async def async_swap_full_volume(self, array, dash, gpu_volume, view, name="cpu_volume", **options):
+        """
+        Upload the full array (in slabs unless a codec is given) and swap its data into
+        the GPU volume built from a proxy, then rerun the view keeping its current state.
+        Other options are passed to async_load_array_to_js.
+        """
+        if options.get("codec") is None and options.get("slab_bytes") is None:
+            options["slab_bytes"] = loaders.SLAB_BYTES
+        cpu_volume = await self.async_load_array_to_js(array, dash, name=name, **options)
+        swap = self.js_function(dash, "swap_volume", transfer.SWAP_ARGUMENTS, transfer.SWAP_BODY)
+        await get(swap(gpu_volume, cpu_volume.data, view))
+        return cpu_volume
+
+    async def async_profile_gpu(self, name, start, nbytes=None):
+        """
+        When profiling, wait for the browser to finish the GPU work queued so far
+        and record it as a stage which began at time.perf_counter() value start.
+        """
+        if profiling.active is None:
+            return
+        await self.async_work_done()
+        profiling.record(name, time.perf_counter() - start, nbytes)
+
+    async def async_work_done(self):
+        "Wait for the browser to finish the GPU work queued so far."
+        await js_await(self.context.onSubmittedWorkDone(), get_result=False)
+
+    def remember_array(self, name, array):
+        "Keep a copy of the array last sent as name."
+        sent_arrays = getattr(self, "sent_arrays", None)
+        if sent_arrays is None:
+            sent_arrays = self.sent_arrays = {}
+        sent_arrays[name] = np.array(array)
+        self.note_copy("remember")
+
+    async def async_update_array_to_js(self, array, dash, name="cpu_volume", max_fraction=0.25, **options):
+        """
+        Update the Javascript volume cached as name to the array.
+        If the volume was loaded with remember=True only the bounding boxes of the changed
+        voxels are sent to patch the volume data in place, unless they cover more than
+        max_fraction of the volume, in which case the whole array is uploaded again.
+        Other options are passed to async_load_array_to_js.
+        Return a reference to the volume.
+        """
+        # the array may have been edited in place since its statistics were cached.
+        statistics.invalidate(array)
+        sent_arrays = getattr(self, "sent_arrays", {})
+        previous = sent_arrays.get(name)
+        boxes = None
+        key = self.shared_volume_keys().get(name)
+        registry = volume_registry.registry_for(dash.gizmo)
+        # never patch a volume other gizmos share.
+        if key is not None and registry.count(key) > 1:
+            previous = None
+        if previous is not None and previous.shape == array.shape:
+            boxes = transfer.changed_boxes(previous, array)
+            if sum(transfer.box_size(box) for box in boxes) > max_fraction * previous.size:
+                boxes = None
+        if boxes is None:
+            options["remember"] = True
+            return await self.async_load_array_to_js(array, dash, name=name, **options)
+        cpu_volume = dash.my(name)
+        patch = self.js_function(dash, "patch_volume", transfer.PATCH_ARGUMENTS, transfer.PATCH_BODY)
+        block_name = name + "_block"
+        shape = [int(n) for n in array.shape]
+        for box in boxes:
+            block = np.ascontiguousarray(array[box])
+            block_reference = await transfer.store_array(dash, block, block_name)
+            start = [s.start for s in box]
+            await get(patch(cpu_volume.data, shape, block_reference, start, list(block.shape)))
+        if boxes:
+            dash.uncache(block_name)
+            if key is not None:
+                # the patched volume no longer matches its content key: keep it only as name.
+                shared_name = registry.forget(key)
+                del self.shared_volume_keys()[name]
+                if shared_name is not None:
+                    self.drop_shared_volume(dash, shared_name)
+        self.remember_array(name, array)
+        return cpu_volume
+
+    async def async_store_buffer(self, array, dash, buffer_name, codec=None):
+        """
+        Transfer the array data to a flat typed array cached as buffer_name in Javascript.
+        The codec may be None (raw bytes), "rle" (run length encoding, for label volumes)
+        or "deflate" (zlib compression).
+        """
+        array = transfer.transfer_ready(array, self.note_copy)
+        if codec is None:
+            return await transfer.store_array(dash, array, buffer_name)
+        elif codec == transfer.RLE:
+            (values, lengths) = transfer.rle_encode(array)
+            values_reference = await transfer.store_array(dash, values, buffer_name + "_values")
+            lengths_reference = await transfer.store_array(dash, lengths, buffer_name + "_lengths")
+            decode = self.js_function(dash, "rle_decode", transfer.RLE_DECODE_ARGUMENTS, transfer.RLE_DECODE_BODY)
+            buffer_reference = dash.cache(buffer_name, decode(values_reference, lengths_reference, array.size))
+            dash.uncache(buffer_name + "_values")
+            dash.uncache(buffer_name + "_lengths")
+            return buffer_reference
+        elif codec == transfer.DEFLATE:
+            compressed_name = buffer_name + "_deflated"
+            compressed_reference = await transfer.store_array(dash, transfer.deflate_encode(array), compressed_name)
+            inflate = self.js_function(dash, "inflate", transfer.INFLATE_ARGUMENTS, transfer.INFLATE_BODY)
+            type_name = transfer.js_array_type(array.dtype)
+            await js_await(inflate(dash.js_object_cache, buffer_name, compressed_reference, type_name))
+            dash.uncache(compressed_name)
+            return dash.my(buffer_name)
+        else:
+            raise ValueError("Unknown transfer codec: " + repr(codec))
+
+    async def async_stream_buffer(self, array, dash, buffer_name, slab_bytes=loaders.SLAB_BYTES, progress=None):
+        """
+        Transfer the array data in slabs along the first axis into a preallocated
+        flat typed array cached as buffer_name in Javascript.
+        Each slab is acknowledged before the next is sent, so at most one slab is in flight.
+        Call progress(sent_bytes, total_bytes) after each slab if given.
+        """
+        dtype = transfer.transfer_dtype(array.dtype)
+        size = int(np.prod(array.shape))
+        plane_size = int(np.prod(array.shape[1:]))
+        total_bytes = size * dtype.itemsize
+        type_name = transfer.js_array_type(dtype)
+        buffer_reference = dash.cache(buffer_name, dash.new(dash.window[type_name], size))
+        assign = self.js_function(dash, "slab_assign", transfer.SLAB_ASSIGN_ARGUMENTS, transfer.SLAB_ASSIGN_BODY)
+        slab_name = buffer_name + "_slab"
+        for (start, stop) in loaders.slab_bounds(array, slab_bytes, dtype.itemsize):
+            slab = np.ascontiguousarray(array[start:stop], dtype=dtype)
+            slab_reference = await transfer.store_array(dash, slab, slab_name)
+            offset = start * plane_size
+            end = await get(assign(buffer_reference, slab_reference, offset))
+            assert end == offset + slab.size, "slab transfer mismatch: " + repr((end, offset, slab.size))
+            if progress is not None:
+                progress(end * dtype.itemsize, total_bytes)
+        dash.uncache(slab_name)
+        return buffer_reference
+
+    def progress_reporter(self, status, label="volume"):
+        "A progress(sent_bytes, total_bytes) callback reporting upload progress through status(text)."
+        def progress(sent_bytes, total_bytes):
+            megabytes = 1024 ** 2
+            percent = 100.0 * sent_bytes / max(1, total_bytes)
+            status("Uploading %s: %d%% (%.1f of %.1f MB)" % (label, percent, sent_bytes / megabytes, total_bytes / megabytes))
+        return progress
+
+    def setup_bricks(self, shape, max_gpu_bytes=None):
+        """
+        Split a volume shape too large for GPU buffers of max_gpu_bytes into overlapping bricks shown one at a time.
+        Return the brick selection components to add to the dashboard (none if the volume fits or max_gpu_bytes is None).
+        Raise ValueError for volumes needing more than bricks.MAX_BRICKS bricks (downsample those).
+        """
+        self.brick_index = 0
+        self.brick_loading = False
+        if max_gpu_bytes is None:
+            # the context requests the largest buffers the device allows: leave it to the device.
+            self.brick_list = None
+            return []
+        self.brick_list = bricks.brick_slices(shape, bricks.max_brick_voxels(max_gpu_bytes))
+        if len(self.brick_list) == 1:
+            self.brick_list = None
+            return []
+        self.brick_text = Text(self.brick_description())
+        self.brick_slider = Slider(minimum=0, maximum=len(self.brick_list) - 1, step=1, value=0, on_change=self.brick_slide)
+        return [self.brick_text, self.brick_slider]
+
+    def brick(self, array):
+        "A view of the current brick of the array (or the whole array if it is not bricked)."
+        if self.brick_list is None:
+            return array
+        return array[self.brick_list[self.brick_index]]
+
+    def brick_description(self):
+        return "Brick %d of %d: %s" % (self.brick_index + 1, len(self.brick_list), bricks.describe(self.brick_list[self.brick_index]))
+
+    def brick_slide(self, *ignored):
+        index = int(self.brick_slider.value)
+        if index == self.brick_index:
+            return
+        self.brick_index = index
+        self.brick_text.text(self.brick_description() + " (loading)")
+        if not self.brick_loading:
+            schedule_task(self.load_bricks_async())
+
+    async def load_bricks_async(self):
+        "Show the selected brick, following the selection until it stops changing."
+        self.brick_loading = True
+        try:
+            loaded = None
+            while loaded != self.brick_index:
+                loaded = self.brick_index
+                await self.show_brick_async()
+            self.brick_text.text(self.brick_description())
+        finally:
+            self.brick_loading = False
+
+    async def show_brick_async(self):
+        "Swap the current brick into the view (implemented by bricked gizmos)."
+        raise NotImplementedError("show_brick_async not implemented for " + repr(type(self)))
+
+    def note_copy(self, reason):
+        "Count a full volume copy made on the way to the browser (a debugging aid, see copy_counts)."
+        counts = getattr(self, "copy_counts", None)
+        if counts is None:
+            counts = self.copy_counts = {}
+        counts[reason] = counts.get(reason, 0) + 1
+
+    def full_copies(self):
+        "Total number of full volume copies this gizmo has made."
+        return sum(getattr(self, "copy_counts", {}).values())
+
+    def js_function(self, dash, name, argument_names, body):
+        "Define a Javascript function in the dash cache once and return a reference to it."
+        functions = getattr(self, "js_functions", None)
+        if functions is None:
+            functions = self.js_functions = {}
+        if name not in functions:
+            functions[name] = dash.cache("function_" + name, dash.function(argument_names, body))
+        return functions[name]
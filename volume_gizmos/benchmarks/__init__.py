@@ -0,0 +1,8 @@
+"""
+Headless benchmarks of the volume gizmos: run the Python side of each gizmo against
+a mock dashboard (mock_dash) over synthetic volumes and report time, memory and bytes sent.
+
+    python -m volume_gizmos.benchmarks --sizes 64 128 --dtypes uint8 float32
+"""
+
+from .suite import run, main
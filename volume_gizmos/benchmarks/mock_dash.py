@@ -0,0 +1,238 @@
+"""
+A local stand-in for the H5Gizmos dashboard of a gizmo, so the Python side of the
+gizmos can be run without a browser.  Javascript references are recorded rather than
+evaluated, except for the few results the Python code checks (see EMULATIONS).
+"""
+
+import contextlib
+import numpy as np
+from .. import VolumeSuper, Triptych, SegmentationQuad, shaded_volume, transfer, gallery
+
+# Typed array class names back to numpy dtypes.
+JS_DTYPES = {name: dtype for (dtype, name) in transfer.JS_ARRAY_TYPES.items()}
+
+# Python versions of the Javascript helpers whose results the gizmos use, by function body.
+EMULATIONS = {
+    transfer.SLAB_ASSIGN_BODY: lambda buffer, slab, offset: offset + len(slab),
+    transfer.PATCH_BODY: lambda data, shape, block, start, block_shape: len(block),
+}
+
+# Modules whose H5Gizmos do, get and js_await are replaced while benchmarking.
+PATCHED_MODULES = [VolumeSuper, Triptych, SegmentationQuad, shaded_volume, transfer, gallery]
+
+class Recorder:
+    """
+    Counts of the dashboard operations of a run and the bytes sent to the browser.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.bytes_sent = 0
+
+    def log(self, kind, nbytes=0):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        self.bytes_sent += nbytes
+
+    def count(self, kind):
+        return self.counts.get(kind, 0)
+
+    # Replacements for the H5Gizmos functions.
+
+    def do(self, reference, to_depth=None):
+        self.log("do")
+
+    async def get(self, reference, to_depth=None, timeout=None):
+        self.log("get")
+        return resolve(reference)
+
+    async def js_await(self, reference, get_result=True):
+        self.log("js_await")
+        if get_result:
+            return resolve(reference)
+
+def resolve(value):
+    "The Python value of a reference (None if unknown), or the value itself."
+    if isinstance(value, MockReference):
+        return value._value
+    return value
+
+def payload_bytes(value):
+    "Bytes of array data in a value sent to Javascript."
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(payload_bytes(item) for item in value)
+    return 0
+
+class MockReference:
+    """
+    A Javascript expression: attributes, items and calls make longer expressions.
+    The Python value of the expression is kept when it is known.  Items of known
+    objects (dictionaries) are known, and assignments to them take effect at once.
+    """
+
+    def __init__(self, dash, path, value=None):
+        self._dash = dash
+        self._path = path
+        self._value = value
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return MockReference(self._dash, self._path + "." + name)
+
+    def __getitem__(self, key):
+        value = None
+        if isinstance(self._value, dict):
+            value = self._value.get(key)
+        return MockReference(self._dash, "%s[%r]" % (self._path, key), value)
+
+    def __call__(self, *arguments):
+        return self._dash.call(self, arguments)
+
+    def __repr__(self):
+        return "MockReference(%r)" % self._path
+
+    def _set(self, key, value):
+        if isinstance(self._value, dict):
+            self._value[key] = resolve(value)
+        return MockReference(self._dash, "%s[%r] = ..." % (self._path, key))
+
+    # Used by the H5Gizmos do and get called from the components.
+
+    def _exec(self, to_depth=None):
+        self._dash.recorder.log("do")
+
+    async def _get(self, to_depth=None, timeout=None):
+        self._dash.recorder.log("get")
+        return self._value
+
+class MockGizmo:
+    """
+    The page side of the mock dashboard: serves transferred arrays through their getters.
+    """
+
+    def __init__(self, dash):
+        self.dash = dash
+        self.getters = {}
+        # attributes used to build an ArrayGetter
+        self._manager = MockManager()
+        self.window = dash.window
+        self.H5Gizmos = MockReference(dash, "H5Gizmos")
+
+    def _add_getter(self, url, getter):
+        self.getters[url] = getter
+        self.dash.recorder.log("store_array", len(getter.bytes))
+
+    def _remove_getter(self, url):
+        del self.getters[url]
+
+    def store_blob(self, url, cache, name, converter):
+        "Store the array served at url in the object cache, like H5Gizmos.store_blob."
+        dtype = JS_DTYPES[converter._path.split("'")[-2]]
+        cache._dash.cached[name] = np.frombuffer(self.getters[url].bytes, dtype=dtype)
+        return name
+
+class MockManager:
+    prefix = "mock"
+    identifier = "mock"
+
+class MockDash:
+    """
+    Stand-in for the dashboard component of a gizmo, recording what is sent to the browser.
+    """
+
+    def __init__(self, recorder=None, gizmo=None):
+        # gizmo: the MockGizmo of another MockDash, to show both components on one page.
+        if recorder is None:
+            recorder = Recorder()
+        self.recorder = recorder
+        self.cached = {}
+        self.window = MockReference(self, "window")
+        # each component has its own object cache, as in H5Gizmos.
+        self.js_object_cache = MockReference(self, "cache", self.cached)
+        if gizmo is None:
+            gizmo = MockGizmo(self)
+        self.gizmo = gizmo
+
+    def call(self, function, arguments):
+        self.recorder.log("call", payload_bytes(list(arguments)))
+        path = function._path + "(...)"
+        if function._path == "H5Gizmos.store_blob":
+            return MockReference(self, path, self.gizmo.store_blob(*arguments))
+        if function._path == "window.Reflect.deleteProperty":
+            (target, key) = arguments
+            if isinstance(resolve(target), dict):
+                resolve(target).pop(key, None)
+            return MockReference(self, path)
+        if callable(function._value):
+            return MockReference(self, path, function._value(*[resolve(argument) for argument in arguments]))
+        return MockReference(self, path)
+
+    def cache(self, name, value):
+        self.recorder.log("cache", payload_bytes(value))
+        self.cached[name] = resolve(value)
+        return self.my(name)
+
+    def uncache(self, name):
+        self.recorder.log("uncache")
+        self.cached.pop(name, None)
+
+    def my(self, name):
+        return MockReference(self, "cache." + name, self.cached.get(name))
+
+    def new(self, constructor, *arguments):
+        self.recorder.log("new", payload_bytes(list(arguments)))
+        value = MockObject(constructor._path, [resolve(argument) for argument in arguments])
+        if constructor._path == "window.Object":
+            value = {}
+        return MockReference(self, "new " + constructor._path + "(...)", value)
+
+    def function(self, argument_names, body):
+        return MockReference(self, "function(%s)" % ", ".join(argument_names), EMULATIONS.get(body))
+
+class MockObject:
+    "A Javascript object made with new, keeping its constructor and arguments."
+
+    def __init__(self, constructor, arguments):
+        self.constructor = constructor
+        self.arguments = arguments
+
+class MockImage:
+    "Stand-in for an H5Gizmos Image, recording changed arrays."
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def change_array(self, array, url=False, scale=False, epsilon=1e-12):
+        self.recorder.log("change_array", np.asarray(array).nbytes)
+
+def attach(gizmo, dash):
+    """
+    Connect a volume gizmo to a mock dashboard as if its page had loaded and its GPU context connected.
+    """
+    gizmo.dash = dash
+    gizmo.web_gpu_volume = dash.window.webgpu_volume
+    gizmo.context = dash.cache("context", gizmo.web_gpu_volume.context())
+    # components have no page element until they are displayed.
+    for value in list(vars(gizmo).values()):
+        components = value if isinstance(value, list) else [value]
+        for component in components:
+            if hasattr(component, "element") and component.element is None:
+                component.element = MockReference(dash, "element")
+    return gizmo
+
+@contextlib.contextmanager
+def patched(recorder):
+    "Replace the H5Gizmos do, get and js_await used by the gizmo modules with the recorder's."
+    saved = []
+    for module in PATCHED_MODULES:
+        for name in ("do", "get", "js_await"):
+            if hasattr(module, name):
+                saved.append((module, name, getattr(module, name)))
+                setattr(module, name, getattr(recorder, name))
+    try:
+        yield recorder
+    finally:
+        for (module, name, value) in saved:
+            setattr(module, name, value)
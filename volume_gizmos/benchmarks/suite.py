@@ -0,0 +1,241 @@
+"""
+Benchmarks of the Python side of the volume gizmos over synthetic volumes,
+reporting wall time, peak traced memory and bytes sent for loads and updates.
+"""
+
+import asyncio
+import time
+import tracemalloc
+import numpy as np
+from . import mock_dash
+from .. import Triptych, SegmentationQuad, shaded_volume, volume_explorer, gallery, loaders, volume_registry
+
+DEFAULT_SIZES = (64, 128, 256)
+DEFAULT_DTYPES = ("uint8", "uint16", "float32")
+NLABELS = 40
+
+def synthetic_volume(size, dtype, seed=0):
+    "A size**3 volume of the dtype: a smooth radial pattern with some noise."
+    (k, j, i) = np.ogrid[0:size, 0:size, 0:size]
+    center = (size - 1) / 2.0
+    radius = np.sqrt(((k - center) ** 2 + (j - center) ** 2 + (i - center) ** 2).astype(np.float32))
+    values = np.cos(radius * (8 * np.pi / size)).astype(np.float32)
+    values += 0.1 * np.random.default_rng(seed).standard_normal(values.shape, dtype=np.float32)
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return values.astype(dtype)
+    top = min(np.iinfo(dtype).max, 4095)
+    return np.clip((values + 1.2) * (top / 2.4), 0, top).astype(dtype)
+
+def synthetic_labels(size):
+    "A size**3 uint8 label volume of concentric shells."
+    (k, j, i) = np.ogrid[0:size, 0:size, 0:size]
+    radius = np.sqrt(k * k + j * j + i * i)
+    return (1 + (radius * (NLABELS / (size * np.sqrt(3)))).astype(np.uint8)).astype(np.uint8)
+
+def changed(array):
+    "A copy of the array with a small block near the center changed (exercises delta updates)."
+    result = np.array(array)
+    n = array.shape[0]
+    block = (slice(n // 2, n // 2 + max(1, n // 8)),) * 3
+    result[block] = result[block][::-1]
+    return result
+
+def measure(function):
+    """
+    Run function(recorder) with the H5Gizmos calls patched and
+    return (result, wall seconds, peak traced megabytes, recorder).
+    """
+    recorder = mock_dash.Recorder()
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with mock_dash.patched(recorder):
+            result = function(recorder)
+        seconds = time.perf_counter() - start
+        (current, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        cancel_pending()
+    return (result, seconds, peak / 1024 ** 2, recorder)
+
+def run_async(coroutine):
+    "Run a coroutine on the benchmark event loop, where H5Gizmos also schedules the component tasks."
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+def cancel_pending():
+    """
+    Cancel the tasks left pending on the benchmark event loop: component start tasks wait
+    for a page which never loads, and would be destroyed pending with their components.
+    """
+    loop = asyncio.get_event_loop()
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+def gizmo_cases(gizmo_name, make_gizmo, load, update):
+    """
+    Measure loading a gizmo (construction and transfer) then updating it.
+    make_gizmo() makes the gizmo, load(gizmo) and update(gizmo) are coroutines.
+    """
+    def load_case(recorder):
+        gizmo = mock_dash.attach(make_gizmo(), mock_dash.MockDash(recorder))
+        run_async(load(gizmo))
+        return gizmo
+    (gizmo, seconds, peak, recorder) = measure(load_case)
+    yield (gizmo_name, "load", seconds, peak, recorder)
+    def update_case(recorder):
+        gizmo.dash.recorder = recorder
+        run_async(update(gizmo))
+    (ignored, seconds, peak, recorder) = measure(update_case)
+    yield (gizmo_name, "update", seconds, peak, recorder)
+
+def triptych_cases(array):
+    reloaded = changed(array)
+    return gizmo_cases("Triptych",
+        lambda: Triptych.Triptych(array, delta=True),
+        lambda gizmo: gizmo.load_volume_async(),
+        lambda gizmo: gizmo.reload_volume_async(reloaded))
+
+def quad_cases(array):
+    labels = synthetic_labels(array.shape[0])
+    changed_labels = changed(labels)
+    return gizmo_cases("SegmentationQuad",
+        lambda: SegmentationQuad.SegmentationQuad(labels, array, delta=True),
+        lambda gizmo: gizmo.load_current_volumes(),
+        lambda gizmo: gizmo.change_volumes(labels=changed_labels))
+
+def shaded_cases(array):
+    labels = synthetic_labels(array.shape[0])
+    async def update(gizmo):
+        # the shaded volume has no update path: measure a brick swap of the same volume.
+        await gizmo.async_swap_full_volume(labels, gizmo.dash, gizmo.gpu_volume, gizmo.mix_view, **gizmo.transfer_options())
+    return gizmo_cases("ShadedVolume",
+        lambda: shaded_volume.ShadedVolume(labels),
+        lambda gizmo: gizmo.load_volume_async(),
+        update)
+
+def shared_cases(array):
+    """
+    Measure a ShadedVolume loading a label volume a Triptych on the same page already sent
+    (it should be aliased, not sent again), then releasing both gizmos' volumes.
+    """
+    labels = synthetic_labels(array.shape[0])
+    first = mock_dash.attach(Triptych.Triptych(labels), mock_dash.MockDash())
+    with mock_dash.patched(first.dash.recorder):
+        run_async(first.load_volume_async())
+    shared = volume_registry.registry_for(first.dash.gizmo).cache._value
+    def load_case(recorder):
+        first.dash.recorder = recorder
+        second = mock_dash.attach(shaded_volume.ShadedVolume(labels), mock_dash.MockDash(recorder, first.dash.gizmo))
+        run_async(second.load_volume_async())
+        assert isinstance(second.dash.cached.get("cpu_volume"), mock_dash.MockObject), "shared volume not found"
+        return second
+    (second, seconds, peak, recorder) = measure(load_case)
+    yield ("Shared", "load", seconds, peak, recorder)
+    def release_case(recorder):
+        for gizmo in (first, second):
+            gizmo.dash.recorder = recorder
+        first.release_volumes(first.dash)
+        assert len(shared) == 1, "shared volume freed while in use"
+        second.release_volumes(second.dash)
+        assert len(shared) == 0, "shared volume not freed"
+    (ignored, seconds, peak, recorder) = measure(release_case)
+    yield ("Shared", "release", seconds, peak, recorder)
+
+def explorer_cases(array, screen_width=256):
+    "Measure building and showing an Explorer then moving its focus (images are sent as bytes)."
+    volume = loaders.scale_to_bytes(array)
+    def build(recorder):
+        explorer = volume_explorer.Explorer(volume, screen_width)
+        for slicer in explorer.slicers:
+            slicer.overview_image = mock_dash.MockImage(recorder)
+            slicer.detail_image = mock_dash.MockImage(recorder)
+            # send the first images as displaying the page would.
+            run_async(slicer.update())
+        return explorer
+    (explorer, seconds, peak, recorder) = measure(build)
+    yield ("Explorer", "load", seconds, peak, recorder)
+    def move(recorder):
+        for slicer in explorer.slicers:
+            slicer.overview_image.recorder = slicer.detail_image.recorder = recorder
+        for indexer in explorer.indexers:
+            indexer.index = indexer.index // 2
+        for slicer in explorer.slicers:
+            run_async(slicer.update_if_needed())
+    (ignored, seconds, peak, recorder) = measure(move)
+    yield ("Explorer", "update", seconds, peak, recorder)
+
+def gallery_cases(array, count=12, shown=4):
+    "Measure showing the first thumbnails of a Gallery, then scrolling to the next ones (evicting the first)."
+    # distinct views of the volume, so the thumbnails are not shared.
+    arrays = [array[offset:] for offset in range(count)]
+    async def show(gizmo, indices):
+        gizmo.visibility_callback([[index, index in indices] for index in range(count)])
+        while gizmo.updates.task is not None:
+            await asyncio.sleep(0.001)
+    async def load(gizmo):
+        await gizmo.observe_async()
+        await show(gizmo, range(shown))
+    # room for the thumbnails in view only.
+    budget = shown * gallery.thumbnail_bytes(array.shape)
+    return gizmo_cases("Gallery",
+        lambda: gallery.Gallery(arrays, gpu_budget=budget, max_rate=None),
+        load,
+        lambda gizmo: show(gizmo, range(shown, 2 * shown)))
+
+CASES = {
+    "triptych": triptych_cases,
+    "quad": quad_cases,
+    "shaded": shaded_cases,
+    "shared": shared_cases,
+    "explorer": explorer_cases,
+    "gallery": gallery_cases,
+}
+
+def run(sizes=DEFAULT_SIZES, dtypes=DEFAULT_DTYPES, gizmos=tuple(CASES), report=print):
+    """
+    Benchmark the gizmos over synthetic volumes of the sizes and dtypes.
+    Return a list of result dictionaries, calling report(line) for each as it completes.
+    """
+    results = []
+    report(header())
+    # one event loop for all the cases, so the component tasks can be cancelled after each.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        for size in sizes:
+            for dtype in dtypes:
+                array = synthetic_volume(size, dtype)
+                for name in gizmos:
+                    for (gizmo_name, case, seconds, peak, recorder) in CASES[name](array):
+                        result = dict(
+                            gizmo=gizmo_name, case=case, shape=array.shape, dtype=str(array.dtype),
+                            seconds=seconds, peak_mb=peak, sent_mb=recorder.bytes_sent / 1024 ** 2,
+                            counts=dict(recorder.counts))
+                        results.append(result)
+                        report(format_result(result))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    return results
+
+def header():
+    return "%-18s %-7s %-16s %-8s %9s %9s %9s %6s %6s" % (
+        "gizmo", "case", "shape", "dtype", "seconds", "peak MB", "sent MB", "do", "get")
+
+def format_result(result):
+    counts = result["counts"]
+    return "%-18s %-7s %-16s %-8s %9.3f %9.1f %9.1f %6d %6d" % (
+        result["gizmo"], result["case"], "x".join(map(str, result["shape"])), result["dtype"],
+        result["seconds"], result["peak_mb"], result["sent_mb"], counts.get("do", 0), counts.get("get", 0))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the volume gizmos without a browser.')
+    parser.add_argument('--sizes', type=int, nargs='+', help='volume edge lengths', default=list(DEFAULT_SIZES))
+    parser.add_argument('--dtypes', nargs='+', help='volume dtypes', default=list(DEFAULT_DTYPES))
+    parser.add_argument('--gizmos', nargs='+', choices=list(CASES), help='gizmos to benchmark', default=list(CASES))
+    args = parser.parse_args()
+    run(args.sizes, args.dtypes, args.gizmos)
@@ -0,0 +1,95 @@
+"""
+Split volumes too large for one GPU buffer into overlapping bricks of equal shape.
+"""
+
+import numpy as np
+
+# WebGPU guarantees storage buffers of at least 128MB (maxStorageBufferBindingSize);
+# the context requests the device's own limit, which is usually larger.
+DEFAULT_MAX_GPU_BYTES = 128 * 1024 ** 2
+
+# Bytes of the GPU volume buffer used by the volume header (shape and matrices).
+HEADER_BYTES = 1024
+
+# Most bricks for one volume: stepping through more with the brick slider is impractical
+# (a 2048 cube of float32 voxels needs 260 bricks of 128MB), so larger volumes should be downsampled.
+MAX_BRICKS = 512
+
+def max_brick_voxels(max_gpu_bytes=DEFAULT_MAX_GPU_BYTES):
+    "Largest number of float32 voxels in a GPU volume buffer of at most max_gpu_bytes."
+    return (max_gpu_bytes - HEADER_BYTES) // 4
+
+def split_size(n, count, overlap):
+    "Size of count bricks covering n positions with overlap shared positions between neighbours."
+    return -(-(n + (count - 1) * overlap) // count)
+
+def split_count(n, size, overlap):
+    "Fewest bricks of at most size positions covering n positions with overlap."
+    if size >= n:
+        return 1
+    if size <= overlap:
+        return None
+    return -(-(n - overlap) // (size - overlap))
+
+def brick_shape(shape, max_voxels, overlap=1):
+    """
+    Shape of equal bricks with at most max_voxels voxels covering a volume shape,
+    choosing the numbers of splits along the axes which give the fewest bricks
+    (so bricks are as close to max_voxels as the overlaps allow).
+    """
+    shape = [int(n) for n in shape]
+    (nk, nj, ni) = shape
+    best = None
+    ck = 1
+    while best is None or ck <= best[0]:
+        bk = split_size(nk, ck, overlap)
+        cj = 1
+        while bk > overlap and (best is None or ck * cj <= best[0]):
+            bj = split_size(nj, cj, overlap)
+            if bj <= overlap:
+                break
+            ci = split_count(ni, max_voxels // (bk * bj), overlap)
+            if ci is not None:
+                bi = split_size(ni, ci, overlap)
+                candidate = (ck * cj * ci, max(bk, bj, bi), [bk, bj, bi])
+                if best is None or candidate[:2] < best[:2]:
+                    best = candidate
+            cj += 1
+        if bk <= overlap:
+            break
+        ck += 1
+    if best is None:
+        raise ValueError("Cannot split shape %s into bricks of %s voxels" % (shape, max_voxels))
+    return best[2]
+
+def axis_starts(n, size, overlap):
+    "Start offsets of bricks of the given size covering n positions with at least overlap shared positions."
+    if size >= n:
+        return [0]
+    starts = list(range(0, n - size, size - overlap))
+    starts.append(n - size)
+    return starts
+
+def brick_slices(shape, max_voxels, overlap=1, max_bricks=MAX_BRICKS):
+    """
+    List of slice tuples selecting overlapping bricks of equal shape which cover a 3d volume,
+    with at most max_voxels voxels each.  A volume that fits is a single brick.
+    Raise ValueError if more than max_bricks bricks are needed (None for no limit).
+    """
+    brick = brick_shape(shape, max_voxels, overlap)
+    axes = [axis_starts(int(n), b, overlap) for (n, b) in zip(shape, brick)]
+    count = int(np.prod([len(starts) for starts in axes]))
+    if max_bricks is not None and count > max_bricks:
+        raise ValueError(
+            "Shape %s needs %d bricks of %s voxels, more than %d: downsample the volume (for example to max_voxels=%d)"
+            % (tuple(shape), count, max_voxels, max_bricks, max_bricks * max_voxels // 2))
+    result = []
+    for k in axes[0]:
+        for j in axes[1]:
+            for i in axes[2]:
+                result.append((slice(k, k + brick[0]), slice(j, j + brick[1]), slice(i, i + brick[2])))
+    return result
+
+def describe(slices):
+    "Text description of a brick like [0:512, 0:1024, 256:768]."
+    return "[" + ", ".join("%d:%d" % (s.start, s.stop) for s in slices) + "]"
@@ -0,0 +1,52 @@
+"""
+Latest-wins coalescing of control events, so dragging a slider sends only as many
+updates to the browser as it can show instead of one for every intermediate position.
+"""
+
+import asyncio
+import inspect
+import time
+from H5Gizmos import schedule_task
+
+# Default maximum number of updates per second delivered for a control.
+DEFAULT_MAX_RATE = 10
+
+class Coalescer:
+    """
+    Callable delivering the most recent value it was called with to callback(value),
+    at most max_rate times per second.  Values arriving while an update waits or runs
+    replace each other, and the last value is always delivered.
+    If the callback returns an awaitable it is awaited before the next update.
+    """
+
+    def __init__(self, callback, max_rate=DEFAULT_MAX_RATE):
+        self.callback = callback
+        self.interval = 0.0
+        if max_rate:
+            self.interval = 1.0 / max_rate
+        self.value = None
+        self.pending = False
+        self.last_update = None
+        self.task = None
+
+    def __call__(self, value):
+        self.value = value
+        self.pending = True
+        if self.task is None:
+            self.task = schedule_task(self.deliver())
+
+    async def deliver(self):
+        try:
+            while self.pending:
+                if self.last_update is not None:
+                    wait = self.last_update + self.interval - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                value = self.value
+                self.pending = False
+                self.last_update = time.monotonic()
+                result = self.callback(value)
+                if inspect.isawaitable(result):
+                    await result
+        finally:
+            self.task = None
@@ -1,12 +1,62 @@
 
 # copied from array_gizmos/color_list.py and modified...
 
-def get_hex_colors(length):
-    "Get length colors -- use duplicates if needed."
-    result = list(range(length))
-    for index in range(length):
-        result[index] = rgbhex(indexed_color(index))
-    return result
+import functools
+import numpy as np
+
+# Hue increment spacing generated hues evenly around the color wheel.
+GOLDEN_RATIO_CONJUGATE = 0.6180339887498949
+
+def get_hex_colors(length, distinct=False):
+    "Get length colors as packed integers -- use duplicates if needed (see get_color_array)."
+    return get_color_array(length, distinct).tolist()
+
+@functools.lru_cache(maxsize=32)
+def get_color_array(length, distinct=False):
+    """
+    Read only uint32 array of length colors packed as RGBA bytes (red in the low byte, like rgbhex).
+    The colors cycle through color_arrays, or if distinct is set continue past them
+    with generated colors (see distinct_colors) instead of repeating.
+    """
+    length = int(length)
+    if distinct and length > len(color_arrays):
+        rgb = distinct_colors(length)
+    else:
+        rgb = color_table[np.arange(length) % len(color_table)]
+    packed = pack_rgb(rgb)
+    packed.setflags(write=False)
+    return packed
+
+def pack_rgb(rgb):
+    "Pack an (n, 3) array of byte RGB colors as uint32 RGBA with opaque alpha."
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    return rgb[:, 0] | (rgb[:, 1] << 8) | (rgb[:, 2] << 16) | np.uint32(255 << 24)
+
+def distinct_colors(length):
+    """
+    An (length, 3) array of byte RGB colors: color_arrays followed by colors with hues
+    spaced by the golden ratio, alternating in saturation and brightness, so nearby labels differ.
+    """
+    index = np.arange(length)
+    hue = (index * GOLDEN_RATIO_CONJUGATE) % 1.0
+    saturation = np.where((index // 3) % 2 == 0, 0.9, 0.6)
+    value = np.choose(index % 3, [1.0, 0.8, 0.6])
+    rgb = hsv_to_rgb(hue, saturation, value)
+    known = min(length, len(color_table))
+    rgb[:known] = color_table[:known]
+    return rgb
+
+def hsv_to_rgb(hue, saturation, value):
+    "Convert arrays of hue, saturation and value in [0, 1] to an (n, 3) array of byte RGB colors."
+    sector = np.floor(hue * 6).astype(int) % 6
+    fraction = hue * 6 - np.floor(hue * 6)
+    p = value * (1 - saturation)
+    q = value * (1 - fraction * saturation)
+    t = value * (1 - (1 - fraction) * saturation)
+    red = np.choose(sector, [value, q, p, p, t, value])
+    green = np.choose(sector, [t, value, value, q, p, p])
+    blue = np.choose(sector, [p, p, t, value, value, q])
+    return np.round(np.stack([red, green, blue], axis=-1) * 255).astype(np.uint32)
 
 def rgbhex(rgb):
     rgba = list(rgb) + [255]
@@ -286,4 +336,6 @@ color_arrays = [
     [43, 219, 123],
     [255, 0, 211],
     [219, 158, 87],
- ]
\ No newline at end of file
+ ]
+
+color_table = np.array(color_arrays, dtype=np.uint32)
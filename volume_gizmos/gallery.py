@@ -0,0 +1,202 @@
+"""
+Gallery of many small volumes shown as maximum projection thumbnails in one dashboard,
+sharing one WebGPU context.  Volumes are uploaded as their thumbnails scroll into view
+and the GPU volumes of thumbnails out of view are freed to stay within a memory budget.
+"""
+
+import collections
+import numpy as np
+from H5Gizmos import serve, get, do, Stack, Text
+from . import VolumeSuper, loaders, bricks, coalesce
+
+# Default GPU memory budget for the gallery volumes and their views.
+DEFAULT_GPU_BUDGET = 4 * bricks.DEFAULT_MAX_GPU_BYTES
+
+# GPU bytes per output pixel of a maximum projection view (a depth buffer of depths and values and two panels).
+VIEW_PIXEL_BYTES = 16
+
+# Report visibility changes of the canvases with ids prefix + index to callback([[index, visible], ...]).
+OBSERVE_ARGUMENTS = ["prefix", "count", "callback", "margin"]
+OBSERVE_BODY = """
+    const observer = new IntersectionObserver(function (entries) {
+        const changes = [];
+        for (const entry of entries) {
+            changes.push([parseInt(entry.target.id.slice(prefix.length)), entry.isIntersecting]);
+        }
+        callback(changes);
+    }, { rootMargin: margin });
+    for (let i = 0; i < count; i++) {
+        observer.observe(document.getElementById(prefix + i));
+    }
+    return count;
+"""
+
+# Free the GPU buffers of a view and its volume (the view must not run again).
+# Every buffer belongs to a data object reachable from the view; the shared context is skipped.
+RELEASE_ARGUMENTS = ["view"]
+RELEASE_BODY = """
+    const seen = new Set();
+    function release(object) {
+        if (object === null || typeof object !== "object" || seen.has(object)) {
+            return;
+        }
+        if (ArrayBuffer.isView(object) || object instanceof ArrayBuffer || object instanceof Node) {
+            return;
+        }
+        seen.add(object);
+        if (object.gpu_buffer) {
+            object.gpu_buffer.destroy();
+            object.gpu_buffer = null;
+        }
+        for (const key of Object.keys(object)) {
+            if (key !== "context") {
+                release(object[key]);
+            }
+        }
+    }
+    release(view);
+    return seen.size;
+"""
+
+def thumbnail_bytes(shape, max_voxels=None):
+    "GPU bytes of the float32 volume and maximum projection view of a thumbnail of a volume shape."
+    if max_voxels is not None:
+        factors = loaders.downsample_factors(shape, max_voxels)
+        shape = [n // f for (n, f) in zip(shape, factors)]
+    # the view projects onto a square covering the volume diagonal.
+    side = int(np.ceil(max(shape) * np.sqrt(2)))
+    return 4 * int(np.prod(shape)) + bricks.HEADER_BYTES + VIEW_PIXEL_BYTES * side * side
+
+class Gallery(VolumeSuper.VolumeGizmo):
+
+    def __init__(self, arrays, names=None, size=160, columns=5, dK=1, dJ=1, dI=1, orbiting=False,
+            max_voxels=None, gpu_budget=DEFAULT_GPU_BUDGET, margin="200px", name="gallery", max_rate=coalesce.DEFAULT_MAX_RATE):
+        # arrays: list of 3d arrays (or LazyVolumes), each shown as a thumbnail
+        # max_voxels: if set thumbnails show volumes reduced to at most this many voxels
+        # gpu_budget: bytes of GPU volumes kept; volumes out of view are freed beyond this
+        # margin: distance outside the window at which thumbnails count as in view (CSS margin)
+        # max_rate: maximum number of thumbnail updates per second while scrolling
+        if names is None:
+            names = ["volume %d" % index for index in range(len(arrays))]
+        assert len(names) == len(arrays), "need one name per array"
+        self.arrays = list(arrays)
+        self.names = list(names)
+        self.size = size
+        self.columns = columns
+        self.dK = dK
+        self.dJ = dJ
+        self.dI = dI
+        self.orbiting = orbiting
+        self.max_voxels = max_voxels
+        self.gpu_budget = gpu_budget
+        self.margin = margin
+        self.name = name
+        self.visible = set()
+        # GPU bytes of the loaded thumbnails, least recently shown first
+        self.loaded = collections.OrderedDict()
+        self.spacing = [None] * len(self.arrays)
+        # Javascript CPU volumes by thumbnail index
+        self.cpu_volumes = {}
+        self.updates = coalesce.Coalescer(self.update_async, max_rate)
+        dash = self.make_dashboard()
+        self.configure_dashboard(dash)
+
+    def make_dashboard(self):
+        size = self.size
+        self.canvas_prefix = self.name + "-canvas-"
+        self.canvases = [self.canvas_component(self.canvas_prefix + str(index), size, size) for index in range(len(self.arrays))]
+        self.status_text = Text("Status")
+        thumbnails = [[canvas, Text(name)] for (canvas, name) in zip(self.canvases, self.names)]
+        rows = [thumbnails[start:start + self.columns] for start in range(0, len(thumbnails), self.columns)]
+        self.dash = Stack([self.status_text] + rows)
+        return self.dash
+
+    def set_status(self, text):
+        self.status_text.text(text)
+
+    async def link(self):
+        await self.dash.link()
+        await self.async_connect_dashboard(self.dash, self.observe_async)
+
+    async def show(self):
+        await self.dash.show()
+        await self.async_connect_dashboard(self.dash, self.observe_async)
+
+    async def observe_async(self):
+        "Start loading thumbnails as they come into view."
+        observe = self.js_function(self.dash, "observe_visibility", OBSERVE_ARGUMENTS, OBSERVE_BODY)
+        await get(observe(self.canvas_prefix, len(self.arrays), self.visibility_callback, self.margin))
+        self.set_status("%d volumes: scroll to view" % len(self.arrays))
+
+    def visibility_callback(self, changes):
+        for (index, visible) in changes:
+            if visible:
+                self.visible.add(int(index))
+            else:
+                self.visible.discard(int(index))
+        self.updates(len(self.visible))
+
+    def thumbnail_array(self, index):
+        "The array shown for a thumbnail (reduced if max_voxels is set), noting its voxel spacing."
+        array = self.arrays[index]
+        factors = [1, 1, 1]
+        if self.max_voxels is not None:
+            (array, factors) = loaders.reduce_volume(array, max_voxels=self.max_voxels)
+        self.spacing[index] = (self.dK * factors[0], self.dJ * factors[1], self.dI * factors[2])
+        return array
+
+    def gpu_bytes(self, index):
+        "GPU bytes of the volume and view of a thumbnail."
+        return thumbnail_bytes(self.arrays[index].shape, self.max_voxels)
+
+    async def update_async(self, ignored=None):
+        "Load the thumbnails in view, freeing the least recently shown volumes out of view beyond the budget."
+        for index in sorted(self.visible):
+            if index in self.loaded:
+                self.loaded.move_to_end(index)
+            else:
+                self.evict(self.gpu_bytes(index))
+                self.set_status("Loading " + self.names[index])
+                await self.load_thumbnail_async(index)
+        self.evict()
+        self.set_status("%d of %d volumes on the GPU (%.1f of %.1f MB)" % (
+            len(self.loaded), len(self.arrays), sum(self.loaded.values()) / 1024 ** 2, self.gpu_budget / 1024 ** 2))
+
+    def evict(self, needed=0):
+        "Free volumes out of view, least recently shown first, until needed more bytes fit the budget."
+        for index in list(self.loaded):
+            if sum(self.loaded.values()) + needed <= self.gpu_budget:
+                break
+            if index not in self.visible:
+                self.release_thumbnail(index)
+
+    async def load_thumbnail_async(self, index):
+        dash = self.dash
+        name = "%s_volume_%d" % (self.name, index)
+        # the CPU volume stays in the page, so a freed thumbnail is restored without another transfer.
+        cpu_volume = self.cpu_volumes.get(index)
+        if cpu_volume is None:
+            cpu_volume = self.cpu_volumes[index] = await self.async_load_array_to_js(self.thumbnail_array(index), dash, name=name)
+        (dK, dJ, dI) = self.spacing[index]
+        gpu_volume = dash.cache(name + "_gpu", cpu_volume.gpu_volume(self.context, dK, dJ, dI))
+        view = dash.cache(name + "_view", dash.new(self.web_gpu_volume.MaxView.Max, gpu_volume))
+        do(view.paint_on(self.canvases[index].element[0], self.orbiting))
+        self.loaded[index] = self.gpu_bytes(index)
+
+    def release_thumbnail(self, index):
+        "Free the GPU volume and view of a thumbnail (its canvas keeps the last image)."
+        dash = self.dash
+        name = "%s_volume_%d" % (self.name, index)
+        release = self.js_function(dash, "release_view", RELEASE_ARGUMENTS, RELEASE_BODY)
+        do(release(dash.my(name + "_view")))
+        dash.uncache(name + "_view")
+        dash.uncache(name + "_gpu")
+        del self.loaded[index]
+
+async def test_gallery():
+    arrays = [np.random.randint(0, 256, (32, 32, 32), dtype=np.uint8) for i in range(20)]
+    gizmo = Gallery(arrays)
+    await gizmo.show()
+
+if __name__ == "__main__":
+    serve(test_gallery)
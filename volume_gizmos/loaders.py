@@ -4,68 +4,802 @@ Load a volume from a file of various formats.
 """
 
 import numpy as np
+import itertools
+import os
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from . import profiling
 
-def load_volume(fn):
+# Target size in bytes for slabs read or processed at one time.
+SLAB_BYTES = 64 * 1024 * 1024
+
+def load_volume(
+        fn,
+        lazy=False,
+        dataset=None,
+        member=None,
+        box=None,
+        stride=None,
+        pages=None,
+        max_voxels=None,
+        downsample=None,
+        reduction="mean",
+        ndim=3,
+        shape=None,
+        dtype=None,
+        offset=0,
+        with_factors=False):
     """
     Load a volume from a file of various formats.
+
+    If lazy is set return a read-only memory mapped array or LazyVolume where the format allows it
+    (npy, uncompressed npz members, raw files, HDF5, Zarr and Nifti) so that only the slabs
+    that are actually indexed are read from disk.
+    Raw files (.raw, .bin) require the shape and dtype of the volume.
+    The dataset selects the HDF5 dataset (or array in a Zarr group) by name and the member selects the npz member by name.
+    The box [(start, stop), ...] and stride restrict the volume to a strided sub-box.
+    The pages slice selects the pages to load from a tiff stack.
+    The max_voxels or downsample factor(s) reduce the volume while streaming it from the file
+    using block means (reduction="mean") or block centers (reduction="subsample", for labels).
+    The ndim is the number of dimensions to look for in containers with several arrays
+    (4 for time series).
+    If with_factors is set return (volume, factors) where factors are the reduction factors
+    per axis (multiply the voxel dimensions by them).
     """
-    if fn.endswith(".npz"):
-        return load_npz(fn)
+    reduce = (max_voxels is not None) or (downsample is not None)
+    # stream from the file when reducing the volume.
+    read_lazily = lazy or reduce
+    start = time.perf_counter()
+    if fn.endswith(".h5") or fn.endswith(".hdf5"):
+        ar = load_h5(fn, dataset=dataset, box=box, stride=stride, lazy=read_lazily, ndim=ndim)
+        # the box and stride are applied by the HDF5 reader
+        box = stride = None
+    elif is_zarr(fn):
+        ar = load_zarr(fn, dataset=dataset, box=box, stride=stride, lazy=read_lazily, ndim=ndim)
+        box = stride = None
+    elif fn.endswith(".npz"):
+        ar = load_npz(fn, lazy=read_lazily, member=member, ndim=ndim)
     elif fn.endswith(".npy"):
-        ar = np.load(fn)
-    elif fn.endswith(".h5"):
-        ar = load_h5(fn)
+        mmap_mode = None
+        if read_lazily:
+            mmap_mode = "r"
+        ar = np.load(fn, mmap_mode=mmap_mode)
+    elif fn.endswith(".raw") or fn.endswith(".bin"):
+        ar = load_raw(fn, shape, dtype, offset=offset, lazy=read_lazily)
     elif fn.endswith(".tif") or fn.endswith(".tiff"):
-        return load_tiff(fn)
+        ar = load_tiff(fn, pages=pages)
     elif fn.endswith(".klb"):
-        return load_klb(fn)
+        ar = load_klb(fn)
     elif fn.endswith(".nii") or fn.endswith(".nii.gz"):
-        return load_nii(fn)
+        ar = load_nii(fn, box=box, stride=stride, lazy=read_lazily)
+        # the box and stride are applied through the Nifti array proxy
+        box = stride = None
     else:
         raise ValueError("Unknown file format: " + fn)
+    if box is not None or stride is not None:
+        ar = select(ar, box, stride)
+        if not read_lazily:
+            ar = np.ascontiguousarray(ar)
+    file_bytes = None
+    if os.path.isfile(fn):
+        file_bytes = os.path.getsize(fn)
+    # lazily loaded data is read (and timed) by the stages that use it.
+    profiling.record("load", time.perf_counter() - start, file_bytes)
+    factors = [1] * len(ar.shape)
+    if reduce:
+        source = ar
+        (ar, factors) = reduce_volume(ar, max_voxels=max_voxels, downsample=downsample, method=reduction)
+        if not lazy:
+            # the file was opened lazily to stream it: read a volume needing no reduction and close the file.
+            ar = materialize(ar)
+            if hasattr(source, "close"):
+                source.close()
+    if with_factors:
+        return (ar, factors)
     return ar
 
-def load_npz(fn):
+def materialize(array):
+    "Read a LazyVolume or memory mapped array into memory (other arrays are returned unchanged)."
+    if isinstance(array, LazyVolume):
+        return array.read()
+    if isinstance(array, np.memmap):
+        return np.array(array)
+    return array
+
+def downsample_factors(shape, max_voxels=None, downsample=None):
+    """
+    Integer reduction factors per axis for a volume shape.
+    Use the downsample factor(s) if given, or else the smallest uniform factor
+    which reduces the volume to at most max_voxels.
+    """
+    ndim = len(shape)
+    if downsample is not None:
+        if np.isscalar(downsample):
+            downsample = [downsample] * ndim
+        factors = [int(f) for f in downsample]
+        assert len(factors) == ndim and min(factors) >= 1, "bad downsample factors " + repr(downsample)
+        return [min(f, n) for (f, n) in zip(factors, shape)]
+    if max_voxels is None:
+        return [1] * ndim
+    size = int(np.prod(shape))
+    factor = max(1, int((size / max_voxels) ** (1.0 / ndim)))
+    def reduced_size(factor):
+        return int(np.prod([max(1, n // factor) for n in shape]))
+    while factor < max(shape) and reduced_size(factor) > max_voxels:
+        factor += 1
+    return [min(factor, n) for n in shape]
+
+def reduce_volume(array, max_voxels=None, downsample=None, method="mean", threads=None):
+    """
+    Reduce an array (or LazyVolume) by the downsample_factors for max_voxels or downsample.
+    Return the reduced array and the factors (multiply the voxel dimensions by the factors).
+    """
+    factors = downsample_factors(array.shape, max_voxels, downsample)
+    with profiling.stage("reduce", profiling.array_bytes(array)):
+        reduced = block_reduce(array, factors, method=method, threads=threads)
+    return (reduced, factors)
+
+def block_reduce(array, factors, method="mean", threads=None, slab_bytes=SLAB_BYTES):
+    """
+    Reduce an array (or LazyVolume) by integer factors per axis.
+
+    The "mean" method averages blocks of voxels reading the array in slabs across a thread pool
+    (integer arrays keep their dtype with rounding).
+    The "subsample" method picks the center voxel of each block, appropriate for labels.
+    Partial blocks at the upper edges are dropped.
+    """
+    factors = [int(f) for f in factors]
+    if all(f == 1 for f in factors):
+        return array
+    reduced_shape = tuple(n // f for (n, f) in zip(array.shape, factors))
+    assert min(reduced_shape) > 0, "reduction factors too large for shape " + repr(array.shape)
+    crop = [m * f for (m, f) in zip(reduced_shape, factors)]
+    if method == "subsample":
+        centers = tuple(slice(f // 2, c, f) for (f, c) in zip(factors, crop))
+        return np.ascontiguousarray(array[centers])
+    if method != "mean":
+        raise ValueError("Unknown reduction method: " + repr(method))
+    out = np.empty(reduced_shape, dtype=array.dtype)
+    integral = np.issubdtype(array.dtype, np.integer)
+    f0 = factors[0]
+    blocked_shape = []
+    for (m, f) in zip(reduced_shape[1:], factors[1:]):
+        blocked_shape.extend([m, f])
+    axes = tuple(range(1, 2 * len(factors), 2))
+    inner = tuple(slice(0, c) for c in crop[1:])
+    def reduce(bound):
+        (start, stop) = bound
+        slab = np.asarray(array[(slice(start * f0, stop * f0),) + inner], dtype=float)
+        blocks = slab.reshape([stop - start, f0] + blocked_shape).mean(axis=axes)
+        if integral:
+            np.rint(blocks, out=blocks)
+        out[start:stop] = blocks
+    if threads is None:
+        threads = os.cpu_count() or 1
+    # float64 temporaries for f0 input planes per output plane.
+    plane_bytes = 8 * f0 * int(np.prod(crop[1:]))
+    depth = max(1, (slab_bytes // threads) // plane_bytes)
+    bounds = [(start, min(start + depth, reduced_shape[0])) for start in range(0, reduced_shape[0], depth)]
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(bounds)))) as executor:
+        for result in executor.map(reduce, bounds):
+            pass
+    return out
+
+def select(array, box=None, stride=None):
+    """
+    Index an array (or LazyVolume) with a box [(start, stop), ...] and a stride.
+    """
+    slices = box_slices(array.shape, box, stride)
+    return array[tuple(slices)]
+
+def box_slices(shape, box=None, stride=None):
+    """
+    Normalize a box [(start, stop), ...] and a stride (number or sequence) to slices for shape.
+    Missing box entries or None bounds cover the whole axis.
+    """
+    ndim = len(shape)
+    if box is None:
+        box = []
+    box = list(box) + [None] * (ndim - len(box))
+    if stride is None:
+        stride = 1
+    if np.isscalar(stride):
+        stride = [stride] * ndim
+    stride = list(stride)
+    assert len(box) == ndim and len(stride) == ndim, "box and stride must match dimensions " + repr(shape)
+    slices = []
+    for (bounds, step, n) in zip(box, stride, shape):
+        if bounds is None:
+            bounds = (None, None)
+        if isinstance(bounds, slice):
+            bounds = (bounds.start, bounds.stop)
+        (start, stop) = bounds
+        step = int(step)
+        if step < 1:
+            raise ValueError("stride must be positive: " + repr(stride))
+        (start, stop, _) = slice(start, stop).indices(n)
+        slices.append(slice(start, max(start, stop), step))
+    return slices
+
+def parse_box(text):
+    """
+    Parse a box specification like "0:100,:,10:50" to [(0, 100), (None, None), (10, 50)].
+    """
+    if text is None:
+        return None
+    box = []
+    for part in text.split(","):
+        bounds = part.strip().split(":")
+        if len(bounds) != 2:
+            raise ValueError("box entries must have the form start:stop -- " + repr(text))
+        box.append(tuple(int(b) if b.strip() else None for b in bounds))
+    return box
+
+def parse_stride(text):
+    """
+    Parse a stride specification like "2" or "1,2,2".
+    """
+    if text is None:
+        return None
+    values = [int(s) for s in text.split(",")]
+    if len(values) == 1:
+        return values[0]
+    return values
+
+def add_arguments(parser):
+    """
+    Add volume loading options to a command line argument parser.
+    """
+    parser.add_argument('--dataset', type=str, help='HDF5 dataset or Zarr array name', default=None)
+    parser.add_argument('--member', type=str, help='npz member array name', default=None)
+    parser.add_argument('--box', type=str, help='sub-box to load, like 0:100,:,10:50', default=None)
+    parser.add_argument('--stride', type=str, help='stride to load, like 2 or 1,2,2', default=None)
+    parser.add_argument('--pages', type=str, help='tiff pages to load, like 100:300 or ::2', default=None)
+    parser.add_argument('--max-voxels', dest='max_voxels', type=int, help='downsample to at most this many voxels', default=None)
+    parser.add_argument('--downsample', type=str, help='downsample factor(s), like 2 or 1,2,2', default=None)
+
+def arguments_options(args):
+    """
+    Get load_volume keyword options from parsed command line arguments.
+    Downsampling options are separate: see arguments_reduction.
+    """
+    return dict(
+        dataset=args.dataset,
+        member=args.member,
+        box=parse_box(args.box),
+        stride=parse_stride(args.stride),
+        pages=parse_slice(args.pages),
+    )
+
+def arguments_spacing(args, fn):
+    """
+    Voxel dimensions (dK, dJ, dI) from the command line arguments,
+    filling in unspecified values from the file header (or 1.0).
+    The dimensions are multiplied by the --stride (strided voxels are larger).
+    """
+    spacing = voxel_spacing(fn, dataset=args.dataset) or (1.0, 1.0, 1.0)
+    given = (args.dK, args.dJ, args.dI)
+    stride = parse_stride(args.stride)
+    if stride is None:
+        stride = 1
+    if np.isscalar(stride):
+        stride = [stride] * 3
+    # the last three axes are the spatial axes (K, J, I).
+    stride = list(stride)[-3:]
+    return tuple((float(g) if g is not None else s) * f for (g, s, f) in zip(given, spacing, stride))
+
+def arguments_reduction(args):
+    """
+    Get reduce_volume keyword options from parsed command line arguments.
+    """
+    return dict(
+        max_voxels=args.max_voxels,
+        downsample=parse_stride(args.downsample),
+    )
+
+class LazyVolume:
+    """
+    Read-only array-like view of a volume stored outside of memory.
+
+    Indexing with integers and slices reads only the selected region.
+    The view may be restricted to a strided box of the source.
+    Subclasses implement read_source(slices) in source coordinates.
+    Subclasses for chunked sources set chunks to the source chunk shape.
+    """
+
+    chunks = None
+
+    def __init__(self, source_shape, dtype, box=None, stride=None):
+        self.source_shape = tuple(source_shape)
+        self.dtype = np.dtype(dtype)
+        self.source_slices = box_slices(self.source_shape, box, stride)
+        self.shape = tuple(len(range(s.start, s.stop, s.step)) for s in self.source_slices)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "%s(shape=%s, dtype=%s)" % (type(self).__name__, self.shape, self.dtype)
+
+    def read_source(self, slices):
+        "Read the slices (with positive steps) of the source volume as an array."
+        raise NotImplementedError("read_source must be defined in subclass.")
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            at = [i for (i, k) in enumerate(key) if k is Ellipsis][0]
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:at] + fill + key[at+1:]
+        if len(key) > self.ndim:
+            raise IndexError("too many indices for volume of shape " + repr(self.shape))
+        key = key + (slice(None),) * (self.ndim - len(key))
+        source = []
+        squeeze = []
+        empty = False
+        for (k, n, s) in zip(key, self.shape, self.source_slices):
+            if isinstance(k, (int, np.integer)):
+                index = int(k)
+                if index < 0:
+                    index += n
+                if not 0 <= index < n:
+                    raise IndexError("index %s out of range for axis of length %s" % (k, n))
+                (start, stop, step) = (index, index + 1, 1)
+                squeeze.append(0)
+            elif isinstance(k, slice):
+                (start, stop, step) = k.indices(n)
+                if step < 1:
+                    raise IndexError("LazyVolume slices must have positive steps.")
+                squeeze.append(slice(None))
+            else:
+                raise TypeError("LazyVolume only supports integer and slice indices: " + repr(k))
+            count = len(range(start, stop, step))
+            if count == 0:
+                empty = True
+                count = 1
+            first = s.start + start * s.step
+            last = first + (count - 1) * step * s.step
+            source.append(slice(first, last + 1, step * s.step))
+        if empty:
+            shape = [len(range(*k.indices(n))) if isinstance(k, slice) else 1 for (k, n) in zip(key, self.shape)]
+            result = np.empty(shape, dtype=self.dtype)
+        else:
+            result = np.asarray(self.read_source(source), dtype=self.dtype)
+        return result[tuple(squeeze)]
+
+    def slab_bounds(self, slab_bytes=SLAB_BYTES):
+        """
+        Generate (start, stop) ranges along the first axis for reading in slabs.
+        Slabs of chunked sources are aligned to whole rows of chunks.
+        """
+        n = self.shape[0]
+        plane_bytes = max(1, self.nbytes // max(1, n))
+        if self.chunks is None:
+            depth = max(1, slab_bytes // plane_bytes)
+            for start in range(0, n, depth):
+                yield (start, min(start + depth, n))
+            return
+        s = self.source_slices[0]
+        # chunk row containing each selected plane
+        rows = (s.start + np.arange(n) * s.step) // self.chunks[0]
+        breaks = [int(b) for b in np.flatnonzero(np.diff(rows)) + 1] + [n]
+        start = 0
+        stop = 0
+        for end in breaks:
+            # extend the slab by whole chunk rows while it stays under the size target.
+            if stop > start and (end - start) * plane_bytes > slab_bytes:
+                yield (start, stop)
+                start = stop
+            stop = end
+        if stop > start:
+            yield (start, stop)
+
+    def read_slab_into(self, out, start, stop):
+        "Read the slab [start:stop] along the first axis into out[start:stop]."
+        out[start:stop] = self[start:stop]
+
+    def read(self, out=None, slab_bytes=SLAB_BYTES):
+        "Read the whole volume slab by slab into a (preallocated) array."
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        assert out.shape == self.shape, "output shape must match " + repr(self.shape)
+        for (start, stop) in self.slab_bounds(slab_bytes):
+            self.read_slab_into(out, start, stop)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        result = self.read()
+        if dtype is not None:
+            result = result.astype(dtype, copy=False)
+        return result
+
+    def astype(self, dtype):
+        return self.read().astype(dtype, copy=False)
+
+    def min(self):
+        return min(self[start:stop].min() for (start, stop) in self.slab_bounds())
+
+    def max(self):
+        return max(self[start:stop].max() for (start, stop) in self.slab_bounds())
+
+def load_npz(fn, lazy=False, member=None, ndim=3):
     """
     Load a volume from a numpy npz file.
+
+    Use the named member, or else the first member with ndim dimensions
+    found by reading only the member headers,
+    so that other members are never decompressed.
+    If lazy is set, uncompressed members are memory mapped directly from the zip file.
     """
-    data = np.load(fn)
-    # look for the first 3d volume in the file
-    for key in data.keys():
-        ar = data[key]
-        if hasattr(ar, "shape") and len(ar.shape) == 3:
+    members = npz_members(fn)
+    if member is None:
+        # look for the first 3d volume in the file
+        candidates = [name for (name, shape, dtype, compressed) in members if len(shape) == ndim]
+        if not candidates:
+            raise ValueError("No %sd array in npz file %s: %s" % (ndim, fn, members))
+        member = candidates[0]
+    elif member not in [m[0] for m in members]:
+        raise KeyError("No member %s in npz file %s: %s" % (repr(member), fn, members))
+    if lazy:
+        ar = npz_member_memmap(fn, member)
+        if ar is not None:
             return ar
-        
-def load_tiff(tiff_path):
+    # compressed member (or eager load): decompress only this member.
+    with np.load(fn) as data:
+        return data[member]
+
+def npz_members(fn):
+    """
+    List (name, shape, dtype, compressed) for the array members of an npz file.
+    Only the member headers are read (and decompressed).
+    """
+    result = []
+    with zipfile.ZipFile(fn) as zf:
+        for info in zf.infolist():
+            if not info.filename.endswith(".npy"):
+                continue
+            with zf.open(info) as f:
+                (shape, fortran_order, dtype) = read_npy_header(f)
+            name = info.filename[:-len(".npy")]
+            compressed = (info.compress_type != zipfile.ZIP_STORED)
+            result.append((name, shape, dtype, compressed))
+    return result
+
+def npz_member_memmap(fn, key):
+    """
+    Memory map an uncompressed member of an npz file as a read-only array.
+    Return None if the member is compressed or cannot be mapped.
+    """
+    member = key
+    if not member.endswith(".npy"):
+        member = key + ".npy"
+    with zipfile.ZipFile(fn) as zf:
+        info = zf.getinfo(member)
+        if info.compress_type != zipfile.ZIP_STORED:
+            return None
+        with open(fn, "rb") as f:
+            # skip the zip local file header to find the start of the npy member
+            f.seek(info.header_offset)
+            header = f.read(30)
+            if header[:4] != b"PK\x03\x04":
+                return None
+            name_length = int.from_bytes(header[26:28], "little")
+            extra_length = int.from_bytes(header[28:30], "little")
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            (shape, fortran_order, dtype) = read_npy_header(f)
+            if dtype.hasobject:
+                return None
+            data_offset = f.tell()
+    order = "C"
+    if fortran_order:
+        order = "F"
+    return np.memmap(fn, dtype=dtype, mode="r", offset=data_offset, shape=shape, order=order)
+
+def read_npy_header(f):
+    """
+    Read the header of an npy stream, leaving the stream positioned at the array data.
+    Return (shape, fortran_order, dtype).
+    """
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+def load_raw(fn, shape, dtype, offset=0, lazy=False):
+    """
+    Load a volume of known shape and dtype from a raw binary file.
+    """
+    if shape is None or dtype is None:
+        raise ValueError("Raw volume files require a shape and dtype: " + fn)
+    ar = np.memmap(fn, dtype=dtype, mode="r", offset=offset, shape=tuple(shape))
+    if not lazy:
+        ar = np.array(ar)
+    return ar
+
+def load_tiff(tiff_path, pages=None, out=None, threads=None):
     """
     Load a volume from a tiff file.
+
+    The pages are decoded in a thread pool directly into one preallocated array.
+    The pages slice (or "start:stop:step" string) selects a subset of the pages.
+    The out may be a preallocated array of the right shape and dtype
+    or a file path for a memory mapped npy output.
     """
+    from PIL import Image
+    with Image.open(tiff_path) as im:
+        npages = getattr(im, "n_frames", 1)
+        first = tiff_page_array(im)
+    if isinstance(pages, str):
+        pages = parse_slice(pages)
+    if pages is None:
+        pages = slice(None)
+    indices = range(npages)[pages]
+    if len(indices) == 0:
+        raise ValueError("No tiff pages selected: " + repr(pages))
+    shape = (len(indices),) + first.shape
+    if out is None:
+        out = np.empty(shape, dtype=first.dtype)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode="w+", dtype=first.dtype, shape=shape)
+    assert out.shape == shape, "tiff output shape must be " + repr(shape)
+    if threads is None:
+        threads = os.cpu_count() or 1
+    threads = max(1, min(threads, len(indices)))
+    def decode(positions):
+        # each worker reads a contiguous run of pages with its own file handle.
+        with Image.open(tiff_path) as page:
+            for position in positions:
+                page.seek(indices[position])
+                out[position] = tiff_page_array(page)
+    runs = np.array_split(np.arange(len(indices)), threads)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for result in executor.map(decode, runs):
+            pass
+    return out
+
+def tiff_page_array(page):
+    "Array for the current tiff page, first channel only, with j and k flipped."
     # copied from mouse_embryo_labeller.tools
-    from PIL import Image, ImageSequence
-    im = Image.open(tiff_path)
-    L = []
-    for i, page in enumerate(ImageSequence.Iterator(im)):
-        a = np.array(page)
-        # only the first channel
-        if len(a.shape) == 3:
-            a = a[:, :, 0]
-        # flip j and k
-        a = a.transpose()
-        L.append(a)
-    All = np.zeros( (len(L),) + L[0].shape, dtype=a.dtype)
-    for (i, aa) in enumerate(L):
-        All[i] = aa
-    return All
-        
-def load_h5(fn):
+    a = np.asarray(page)
+    # only the first channel
+    if len(a.shape) == 3:
+        a = a[:, :, 0]
+    # flip j and k
+    return a.transpose()
+
+def parse_slice(text):
+    """
+    Parse a slice specification like "10:200:2" or "5".
+    """
+    if text is None:
+        return None
+    parts = [int(p) if p.strip() else None for p in text.split(":")]
+    if len(parts) == 1:
+        return slice(parts[0], parts[0] + 1)
+    return slice(*parts)
+
+def load_h5(fn, dataset=None, box=None, stride=None, lazy=False, ndim=3):
     """
     Load a volume from an HDF5 file.
+
+    The dataset defaults to "data" or else the first dataset with ndim dimensions in the file.
+    Data is read in chunk aligned slabs directly into the output array.
+    If lazy is set return an H5Volume which reads only the regions that are indexed.
+    """
+    try:
+        import h5py
+    except ImportError:
+        print ("The h5py package is required for HDF5 file loading.")
+        print ("It is not automatically installed with this package.")
+        print ("  pip install h5py")
+        raise
+    f = h5py.File(fn, "r")
+    try:
+        volume = H5Volume(find_h5_dataset(f, dataset, ndim), box=box, stride=stride)
+        if lazy:
+            return volume
+        return volume.read()
+    finally:
+        if not lazy:
+            f.close()
+
+def find_h5_dataset(f, name=None, ndim=3):
+    """
+    Find a named dataset in an open HDF5 file, or "data", or the first dataset with ndim dimensions.
+    """
+    import h5py
+    if name is not None:
+        return f[name]
+    if isinstance(f.get("data"), h5py.Dataset):
+        return f["data"]
+    found = []
+    def visit(name, item):
+        if isinstance(item, h5py.Dataset) and item.ndim == ndim:
+            found.append(item)
+            return True
+    f.visititems(visit)
+    if not found:
+        raise ValueError("No %sd dataset found in HDF5 file: %s" % (ndim, repr(f.filename)))
+    return found[0]
+
+class H5Volume(LazyVolume):
+    """
+    Lazy view of a (possibly chunked and compressed) HDF5 dataset.
+    """
+
+    def __init__(self, dataset, box=None, stride=None):
+        self.dataset = dataset
+        self.chunks = dataset.chunks
+        super().__init__(dataset.shape, dataset.dtype, box=box, stride=stride)
+
+    def read_source(self, slices):
+        return self.dataset[tuple(slices)]
+
+    def read_slab_into(self, out, start, stop):
+        s = self.source_slices[0]
+        source = [slice(s.start + start * s.step, s.start + (stop - 1) * s.step + 1, s.step)]
+        source += self.source_slices[1:]
+        self.dataset.read_direct(out, source_sel=tuple(source), dest_sel=np.s_[start:stop])
+
+    def close(self):
+        self.dataset.file.close()
+
+def load_zarr(path, dataset=None, box=None, stride=None, lazy=False, threads=None, ndim=3):
+    """
+    Load a volume from a local Zarr (format version 2) directory store.
+
+    The dataset names an array inside a Zarr group; by default the first array with ndim dimensions is used.
+    Only the chunks covering the selected region are read, decoded in a thread pool.
+    If lazy is set return a ZarrVolume which reads only the regions that are indexed.
+    """
+    volume = ZarrVolume(find_zarr_array(path, dataset, ndim), box=box, stride=stride, threads=threads)
+    if lazy:
+        return volume
+    return volume.read()
+
+def is_zarr(path):
+    "Test whether the path is a Zarr directory store."
+    return os.path.isdir(path) and (
+        path.rstrip("/").endswith(".zarr") or
+        os.path.exists(os.path.join(path, ".zarray")) or
+        os.path.exists(os.path.join(path, ".zgroup"))
+    )
+
+def find_zarr_array(path, name=None, ndim=3):
+    """
+    Find the directory of a named array in a Zarr store, or the store array,
+    or the first array with ndim dimensions.
+    """
+    import json
+    if name is not None:
+        path = os.path.join(path, name)
+    if os.path.exists(os.path.join(path, ".zarray")):
+        return path
+    if name is None:
+        for (directory, subdirectories, files) in os.walk(path):
+            subdirectories.sort()
+            if ".zarray" in files:
+                with open(os.path.join(directory, ".zarray")) as f:
+                    if len(json.load(f)["shape"]) == ndim:
+                        return directory
+    raise ValueError("No Zarr array found at " + repr(path))
+
+class ZarrVolume(LazyVolume):
+    """
+    Lazy view of an array in a local Zarr (format version 2) directory store.
     """
-    raise NotImplementedError("HDF5 loading not implemented yet.")
-    #import h5py
-    #with h5py.File(fn, "r") as f:
-    #    ar = f["data"][:]
-    #return ar
+
+    def __init__(self, path, box=None, stride=None, threads=None):
+        import json
+        self.path = path
+        with open(os.path.join(path, ".zarray")) as f:
+            self.metadata = metadata = json.load(f)
+        if metadata.get("zarr_format", 2) != 2:
+            raise ValueError("Only Zarr format version 2 is supported: " + repr(path))
+        self.chunks = tuple(metadata["chunks"])
+        self.order = metadata.get("order", "C")
+        self.separator = metadata.get("dimension_separator") or "."
+        self.fill_value = metadata.get("fill_value")
+        if self.fill_value is None:
+            self.fill_value = 0
+        self.compressor = zarr_codec(metadata.get("compressor"))
+        self.filters = [zarr_codec(config) for config in (metadata.get("filters") or [])]
+        if threads is None:
+            threads = os.cpu_count() or 1
+        self.threads = threads
+        super().__init__(metadata["shape"], metadata["dtype"], box=box, stride=stride)
+
+    def read_chunk(self, index):
+        "Decode the chunk at the chunk grid index (missing chunks are filled)."
+        key = self.separator.join(str(i) for i in index)
+        filename = os.path.join(self.path, key)
+        if not os.path.exists(filename):
+            return np.full(self.chunks, self.fill_value, dtype=self.dtype)
+        with open(filename, "rb") as f:
+            data = f.read()
+        if self.compressor is not None:
+            data = self.compressor(data)
+        for decode in reversed(self.filters):
+            data = decode(data)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.chunks, order=self.order)
+
+    def read_source(self, slices):
+        shape = [len(range(s.start, s.stop, s.step)) for s in slices]
+        out = np.empty(shape, dtype=self.dtype)
+        # for each axis: (chunk index, slice within chunk, slice within output) for covering chunks
+        axis_pieces = []
+        for (s, size, chunk) in zip(slices, shape, self.chunks):
+            pieces = []
+            last = s.start + (size - 1) * s.step
+            for q in range(s.start // chunk, last // chunk + 1):
+                low = q * chunk
+                high = low + chunk - 1
+                first_t = max(0, -(-(low - s.start) // s.step))
+                last_t = min(size - 1, (high - s.start) // s.step)
+                if first_t > last_t:
+                    continue
+                local = slice(s.start + first_t * s.step - low, s.start + last_t * s.step - low + 1, s.step)
+                pieces.append((q, local, slice(first_t, last_t + 1)))
+            axis_pieces.append(pieces)
+        def copy_chunk(combination):
+            index = tuple(piece[0] for piece in combination)
+            local = tuple(piece[1] for piece in combination)
+            target = tuple(piece[2] for piece in combination)
+            out[target] = self.read_chunk(index)[local]
+        combinations = list(itertools.product(*axis_pieces))
+        threads = max(1, min(self.threads, len(combinations)))
+        if threads == 1:
+            for combination in combinations:
+                copy_chunk(combination)
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                for result in executor.map(copy_chunk, combinations):
+                    pass
+        return out
+
+def zarr_codec(config):
+    """
+    Decoding function for a Zarr compressor or filter configuration (or None for no compression).
+    zlib, gzip, bz2 and lzma are built in; other codecs require numcodecs.
+    """
+    if config is None:
+        return None
+    codec_id = config.get("id")
+    if codec_id == "zlib":
+        import zlib
+        return zlib.decompress
+    if codec_id == "gzip":
+        import gzip
+        return gzip.decompress
+    if codec_id == "bz2":
+        import bz2
+        return bz2.decompress
+    if codec_id == "lzma":
+        import lzma
+        return lzma.decompress
+    try:
+        import numcodecs
+    except ImportError:
+        print ("The numcodecs package is required for the Zarr codec", repr(codec_id))
+        print ("It is not automatically installed with this package.")
+        print ("  pip install numcodecs")
+        raise
+    codec = numcodecs.get_codec(config)
+    return lambda data: bytes(codec.decode(data))
 
 def load_klb(fn):
     """
@@ -80,10 +814,22 @@ def load_klb(fn):
     ar = pyklb.readfull(fn)
     return ar
 
-def load_nii(fn):
+def load_nii(fn, box=None, stride=None, lazy=False):
     """
     Load a volume from a Nifti file.
+
+    The data keeps its on-disk dtype unless the header requires scaling (then float32).
+    The box and stride select a sub-volume which is read through the nibabel array proxy.
+    If lazy is set return a NiftiVolume which reads only the regions that are indexed.
     """
+    img = open_nii(fn)
+    volume = NiftiVolume(img, box=box, stride=stride)
+    if lazy:
+        return volume
+    return volume.read()
+
+def open_nii(fn):
+    "Open a Nifti image without reading the data."
     try:
         import nibabel as nib
     except ImportError:
@@ -92,20 +838,132 @@ def load_nii(fn):
         print ("  pip install nibabel")
         print ("Please install nibabel.")
         raise
-    img = nib.load(fn)
-    ar = img.get_fdata()
-    return ar
+    return nib.load(fn)
+
+class NiftiVolume(LazyVolume):
+    """
+    Lazy view of Nifti image data read through the nibabel array proxy.
+    """
+
+    def __init__(self, img, box=None, stride=None):
+        self.img = img
+        self.proxy = img.dataobj
+        shape = tuple(img.shape)
+        # drop trailing singleton dimensions beyond 3d
+        self.trailing = ()
+        while len(shape) > 3 and shape[-1] == 1:
+            shape = shape[:-1]
+            self.trailing += (0,)
+        slope = getattr(self.proxy, "slope", 1.0)
+        inter = getattr(self.proxy, "inter", 0.0)
+        self.scaled = not (slope in (1.0, None) and inter in (0.0, None))
+        dtype = img.get_data_dtype()
+        if self.scaled:
+            dtype = np.float32
+        super().__init__(shape, dtype, box=box, stride=stride)
+
+    def read_source(self, slices):
+        # the proxy applies scl_slope and scl_inter only when they are not the identity.
+        return np.asarray(self.proxy[tuple(slices) + self.trailing])
+
+def voxel_spacing(fn, dataset=None):
+    """
+    Voxel dimensions (dK, dJ, dI) recorded in the file header, or None if unknown.
+    Supported for Nifti files and HDF5 datasets with an element_size_um attribute.
+    """
+    if fn.endswith(".nii") or fn.endswith(".nii.gz"):
+        zooms = open_nii(fn).header.get_zooms()
+        if len(zooms) >= 3:
+            return tuple(float(z) for z in zooms[:3])
+    elif fn.endswith(".h5") or fn.endswith(".hdf5"):
+        import h5py
+        with h5py.File(fn, "r") as f:
+            spacing = find_h5_dataset(f, dataset).attrs.get("element_size_um")
+            if spacing is not None and len(spacing) == 3:
+                return tuple(float(z) for z in spacing)
+    return None
+
+def slab_bounds(array, slab_bytes=SLAB_BYTES, itemsize=None):
+    """
+    List (start, stop) ranges along the first axis of an array or LazyVolume for slab processing.
+    The itemsize (default array itemsize) is the bytes per voxel of the slab temporaries.
+    """
+    if isinstance(array, LazyVolume) and itemsize is None:
+        return list(array.slab_bounds(slab_bytes))
+    if itemsize is None:
+        itemsize = array.dtype.itemsize
+    n = array.shape[0]
+    plane_bytes = max(1, itemsize * int(np.prod(array.shape[1:])))
+    depth = max(1, slab_bytes // plane_bytes)
+    return [(start, min(start + depth, n)) for start in range(0, n, depth)]
 
-def scale_to_bytes(array):
+def map_slabs(function, array, threads=None, slab_bytes=SLAB_BYTES, itemsize=None):
+    """
+    Call function(start, stop, slab) for slabs along the first axis of the array in a thread pool.
+    Return the list of results in slab order.
+    The slab_bytes bounds the total size of the slab temporaries of all threads together.
+    """
+    if threads is None:
+        threads = os.cpu_count() or 1
+    bounds = slab_bounds(array, max(1, slab_bytes // threads), itemsize)
+    threads = max(1, min(threads, len(bounds)))
+    def apply(bound):
+        (start, stop) = bound
+        return function(start, stop, np.asarray(array[start:stop]))
+    if threads == 1:
+        return [apply(bound) for bound in bounds]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(apply, bounds))
+
+def value_range(array, threads=None):
+    """
+    Minimum and maximum of an array computed in one slab by slab pass.
+    Non-finite values (NaN and infinities) are left out; (0, 0) if there are no finite values.
+    """
+    def extremes(start, stop, slab):
+        if slab.dtype.kind == "f":
+            finite = np.isfinite(slab)
+            if not finite.all():
+                slab = slab[finite]
+        if slab.size == 0:
+            return None
+        return (slab.min(), slab.max())
+    ranges = [r for r in map_slabs(extremes, array, threads) if r is not None]
+    if not ranges:
+        return (0, 0)
+    return (min(r[0] for r in ranges), max(r[1] for r in ranges))
+
+def scale_to_bytes(array, percentiles=None, out=None, threads=None):
     """
     Scale an array to bytes for transfer.
+
+    The array is processed in slabs across a thread pool writing directly into
+    a preallocated uint8 output, so temporaries are bounded by the slab size.
+    If percentiles=(low, high) is given clip at those percentiles (from the cached
+    statistics of the array) instead of the min and max (from a single range pass).
     """
-    mn = array.min()
-    mx = array.max()
-    array1 = (array.astype(float) - mn) 
-    if mx != mn:
-        array1 = array1 / (mx - mn)
-    array8 = (array1 * 255)
-    array8 = np.clip(array8, 0, 255)  # Ensure values are in the range [0, 255]
-    array8 = array8.astype(np.uint8)
-    return array8
+    if percentiles is not None:
+        # statistics uses the slab helpers of this module.
+        from . import statistics
+        (mn, mx) = statistics.volume_statistics(array, threads).percentiles(percentiles)
+    else:
+        (mn, mx) = value_range(array, threads)
+    (mn, mx) = (float(mn), float(mx))
+    began = time.perf_counter()
+    if out is None:
+        out = np.empty(array.shape, dtype=np.uint8)
+    assert out.shape == array.shape and out.dtype == np.uint8, "output must be uint8 with shape " + repr(array.shape)
+    def scale(start, stop, slab):
+        array1 = slab.astype(float)
+        array1 -= mn
+        if mx != mn:
+            array1 /= (mx - mn)
+        array1 *= 255
+        np.clip(array1, 0, 255, out=array1)  # Ensure values are in the range [0, 255]
+        if slab.dtype.kind == "f":
+            np.nan_to_num(array1, copy=False, nan=0.0)  # NaN shows as 0
+        out[start:stop] = array1
+    # float64 temporaries are 8 bytes per voxel.
+    map_slabs(scale, array, threads, itemsize=8)
+    profiling.record("convert", time.perf_counter() - began, profiling.array_bytes(array))
+    return out
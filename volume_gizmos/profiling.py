@@ -0,0 +1,101 @@
+"""
+Per-stage timings and byte counts for the volume loading pipeline
+(load, reduce, convert, transfer, GPU upload, first frame).
+
+Profiling is off until enable() is called; stages are then recorded in the active Profile.
+"""
+
+import contextlib
+import time
+
+# The Profile recording stages, or None when profiling is disabled.
+active = None
+
+class Profile:
+
+    def __init__(self):
+        self.records = []
+        self.hooks = []
+
+    def add_hook(self, callback):
+        "Call callback(record) for each stage recorded, where a record is a dictionary (see record)."
+        self.hooks.append(callback)
+
+    def record(self, name, seconds, nbytes=None):
+        "Record a stage duration in seconds and the number of bytes it processed (or None)."
+        entry = dict(stage=name, seconds=seconds, bytes=nbytes)
+        self.records.append(entry)
+        for hook in self.hooks:
+            hook(entry)
+        return entry
+
+    @contextlib.contextmanager
+    def stage(self, name, nbytes=None):
+        "Context manager recording the time spent in the block as a stage."
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, nbytes)
+
+    def report(self):
+        "List of the stage records in order."
+        return list(self.records)
+
+    def summary(self):
+        "Dictionary mapping stage names to total (seconds, bytes), in order of first occurrence."
+        result = {}
+        for entry in self.records:
+            (seconds, nbytes) = result.get(entry["stage"], (0.0, 0))
+            result[entry["stage"]] = (seconds + entry["seconds"], nbytes + (entry["bytes"] or 0))
+        return result
+
+    def format(self):
+        "The summary as a printable table."
+        lines = ["%-16s %10s %12s" % ("stage", "seconds", "MB")]
+        total = 0.0
+        for (name, (seconds, nbytes)) in self.summary().items():
+            lines.append("%-16s %10.3f %12.1f" % (name, seconds, nbytes / 1024 ** 2))
+            total += seconds
+        lines.append("%-16s %10.3f" % ("total", total))
+        return "\n".join(lines)
+
+def enable(profile=None):
+    "Start recording stages in the profile (default a new Profile) and return it."
+    global active
+    if profile is None:
+        profile = Profile()
+    active = profile
+    return profile
+
+def disable():
+    global active
+    active = None
+
+def stage(name, nbytes=None):
+    "Context manager recording a stage in the active profile, if any."
+    if active is None:
+        return contextlib.nullcontext()
+    return active.stage(name, nbytes)
+
+def record(name, seconds, nbytes=None):
+    "Record a stage in the active profile, if any."
+    if active is not None:
+        active.record(name, seconds, nbytes)
+
+def array_size(array):
+    "Number of voxels in an array (or LazyVolume)."
+    size = 1
+    for n in array.shape:
+        size *= int(n)
+    return size
+
+def array_bytes(array):
+    "Size of an array (or LazyVolume) in bytes."
+    return array_size(array) * array.dtype.itemsize
+
+async def link_and_report(gizmo):
+    "Link a gizmo (loading its volumes) then print the profile if profiling is enabled."
+    await gizmo.link()
+    if active is not None:
+        print(active.format())
@@ -0,0 +1,108 @@
+"""
+Compact segmentation labels which don't fit 16 bits to consecutive ids in the smallest
+unsigned dtype, keeping the original label ids for reporting.
+"""
+
+import numpy as np
+from . import statistics
+
+# Largest lookup table (in entries) used for relabeling; wider label ranges use np.unique.
+LOOKUP_LIMIT = 2 ** 26
+
+# Labels are float32 on the GPU, which represents integers exactly up to 2**24.
+MAX_LABELS = 2 ** 24
+
+# Non-negative labels up to this value are sent with their own ids rather than renumbered.
+RAW_LIMIT = np.iinfo(np.uint16).max
+
+def label_dtype(max_label):
+    "The smallest unsigned dtype holding labels up to max_label."
+    assert max_label <= MAX_LABELS, "Too many labels for the GPU: " + repr(max_label)
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+
+def present_labels(labels, threads=None):
+    """
+    Sorted array of the distinct label values, found with a lookup table (one slab by slab pass)
+    when the label range is at most LOOKUP_LIMIT, otherwise with np.unique.
+    """
+    from .loaders import map_slabs
+    if np.dtype(labels.dtype).kind not in "iub":
+        return np.unique(np.asarray(labels))
+    stats = statistics.volume_statistics(labels, threads)
+    if stats.dtype.itemsize <= 2:
+        # 8 and 16 bit statistics count every value.
+        return stats.levels[stats.counts > 0]
+    (lowest, highest) = (int(stats.minimum), int(stats.maximum))
+    if highest - lowest >= LOOKUP_LIMIT:
+        return np.unique(np.asarray(labels))
+    present = np.zeros(highest - lowest + 1, dtype=bool)
+    def mark(start, stop, slab):
+        # subtract in int64: the labels' own dtype may overflow.
+        present[slab.reshape(-1).astype(np.int64) - lowest] = True
+    map_slabs(mark, labels, threads, itemsize=8)
+    return np.flatnonzero(present) + lowest
+
+def compact_labels(labels, out=None, threads=None, original_ids=None):
+    """
+    Labels in an unsigned dtype of at most 16 bits if possible, and the original ids.
+    Non-negative labels up to RAW_LIMIT keep their ids (converted into out if given) and the original
+    ids are None.  Otherwise label 0 (background) stays 0 and the other labels are numbered from 1,
+    and original_ids[label] is the original id of each compacted label.
+    Given the original_ids of an earlier compaction (or the identity np.arange(n) for labels
+    not compacted so far) labels keep their numbers and new ids are numbered after them,
+    so editing labels does not renumber the others.
+    Return (compacted, original_ids).
+    """
+    from .loaders import map_slabs
+    ids = present_labels(labels, threads)
+    ids = ids[ids != 0]
+    identity = original_ids is None or np.array_equal(original_ids, np.arange(len(original_ids)))
+    if identity and (len(ids) == 0 or (ids[0] >= 0 and ids[-1] <= RAW_LIMIT)):
+        dtype = label_dtype(int(ids[-1]) if len(ids) else 0)
+        if isinstance(labels, np.ndarray) and labels.dtype == dtype:
+            return (labels, None)
+        out = label_output(labels, dtype, out)
+        def convert(start, stop, slab):
+            out[start:stop] = slab
+        map_slabs(convert, labels, threads)
+        return (out, None)
+    if original_ids is None:
+        original_ids = np.concatenate([[0], ids])
+    else:
+        new_ids = np.setdiff1d(ids, original_ids)
+        if len(new_ids) > 0:
+            original_ids = np.concatenate([original_ids, new_ids])
+    dtype = label_dtype(len(original_ids) - 1)
+    out = label_output(labels, dtype, out)
+    # compact labels of the sorted (nonzero) original ids.
+    order = np.argsort(original_ids[1:], kind="stable")
+    known = original_ids[1:][order]
+    numbers = (order + 1).astype(dtype)
+    (lowest, highest) = (min(0, int(known[0])), int(known[-1]))
+    # label values index a lookup table of new labels, or else are searched in the sorted ids.
+    if np.dtype(labels.dtype).kind in "iub" and highest - lowest < LOOKUP_LIMIT:
+        lookup = np.zeros(highest - lowest + 1, dtype=dtype)
+        lookup[known.astype(np.int64) - lowest] = numbers
+        def relabel(start, stop, slab):
+            out[start:stop] = lookup[slab.astype(np.int64) - lowest]
+    else:
+        def relabel(start, stop, slab):
+            compact = numbers[np.minimum(np.searchsorted(known, slab), len(known) - 1)]
+            compact[slab == 0] = 0
+            out[start:stop] = compact
+    map_slabs(relabel, labels, threads, itemsize=8)
+    return (out, original_ids)
+
+def label_output(labels, dtype, out=None):
+    "The out array if it suits labels converted to dtype, or else a new array."
+    if out is None or out.shape != labels.shape or out.dtype != dtype:
+        out = np.empty(labels.shape, dtype=dtype)
+    return out
+
+def original_label(original_ids, label):
+    "The original id of a compacted label (the label itself if the labels were not compacted)."
+    if original_ids is None:
+        return int(label)
+    return int(original_ids[int(label)])
@@ -5,17 +5,27 @@ Colorized index volume with shading.
 
 import numpy as np
 from H5Gizmos import Html, serve, get, do, Stack, Slider, Text
-from . import VolumeSuper, loaders, color_list
+from . import VolumeSuper, loaders, color_list, profiling, bricks, statistics
 import os
+import time
 
 class ShadedVolume(VolumeSuper.VolumeGizmo):
 
-    def __init__(self, array, hex_colors=None, size=512, dI=1, dJ=1, dK=1, ratio=0.7, rotate=True):
+    def __init__(self, array, hex_colors=None, size=512, dI=1, dJ=1, dK=1, ratio=0.7, rotate=True, codec=None, slab_bytes=None, progressive=False,
+            max_gpu_bytes=None):
+        # codec: optional compressed transfer encoding ("rle" suits index volumes)
+        # slab_bytes: if set upload the volume in slabs of about this size with progress reports
+        # progressive: paint a coarse proxy first, then swap in the full resolution volume
+        # max_gpu_bytes: if set larger volumes are split into bricks shown one at a time
+        self.max_gpu_bytes = max_gpu_bytes
+        self.codec = codec
+        self.progressive = progressive
+        self.slab_bytes = slab_bytes
         self.ratio = ratio
         self.orbiting = rotate
         self.array = array
         if hex_colors is None:
-            hex_colors = [0] + color_list.get_hex_colors(array.max())
+            hex_colors = np.concatenate([[0], color_list.get_color_array(statistics.volume_statistics(array).maximum, distinct=True)])
         self.hex_colors = np.array(hex_colors, dtype=np.uint32)
         self.size = size
         dash = self.make_dashboard()
@@ -31,12 +41,21 @@ class ShadedVolume(VolumeSuper.VolumeGizmo):
         self.dash = Stack([
             self.shade_canvas,
             self.status_text,
-        ])
+        ] + self.setup_bricks(self.array.shape, self.max_gpu_bytes))
         return self.dash
     
     def status(self, text):
         self.status_text.text(text)
     
+    def transfer_options(self):
+        "Options for async_load_array_to_js."
+        return dict(codec=self.codec, slab_bytes=self.slab_bytes, progress=self.progress_reporter(self.status))
+
+    async def show_brick_async(self):
+        self.status("Loading " + self.brick_description())
+        await self.async_swap_full_volume(self.brick(self.array), self.dash, self.gpu_volume, self.mix_view, **self.transfer_options())
+        self.status(self.brick_description())
+
     async def link(self):
         await self.dash.link()
         await self.async_connect_dashboard(self.dash, self.load_volume_async)
@@ -51,12 +70,29 @@ class ShadedVolume(VolumeSuper.VolumeGizmo):
         web_gpu_volume = self.web_gpu_volume
         context = self.context
         dash = self.dash
-        cpu_volume = await self.async_load_array_to_js(self.array, dash)
+        options = self.transfer_options()
+        array = self.brick(self.array)
+        if self.progressive:
+            # index volume: sample rather than average
+            cpu_volume = await self.async_load_proxy_to_js(array, dash, method="subsample")
+        else:
+            cpu_volume = await self.async_load_array_to_js(array, dash, **options)
         [dK, dJ, dI] = [self.dK, self.dJ, self.dI]
+        start = time.perf_counter()
         gpu_volume = dash.cache("gpu_volume", cpu_volume.gpu_volume(context, dK, dJ, dI))
+        self.gpu_volume = gpu_volume
+        await self.async_profile_gpu("gpu upload", start, 4 * profiling.array_size(array))
+        if self.progressive or self.brick_list is not None:
+            # use the value range of the whole volume (for every brick).
+            self.set_value_range(dash, gpu_volume, self.array)
+        start = time.perf_counter()
         view_init = dash.new(web_gpu_volume.MixView.Mix, gpu_volume, self.hex_colors, self.ratio)
         self.mix_view = dash.cache("mix_view", view_init)
         do(self.mix_view.paint_on(self.shade_canvas.element[0], self.orbiting))
+        await self.async_profile_gpu("first frame", start)
+        if self.progressive:
+            self.status("preview: loading full resolution...")
+            await self.async_swap_full_volume(array, dash, gpu_volume, self.mix_view, **options)
         self.status("loaded")
 
 async def test_shaded_volume():
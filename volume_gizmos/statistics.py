@@ -0,0 +1,168 @@
+"""
+Volume statistics (range, histogram, percentiles, nonzero count) computed slab by slab
+in a thread pool and cached per array, so gizmos scan each volume once.
+"""
+
+import time
+import weakref
+import numpy as np
+from . import profiling
+
+# Number of histogram bins for volumes which are not 8 or 16 bit integers.
+BINS = 65536
+
+# Cached statistics by array id, removed when the array is collected (see volume_statistics).
+cache = {}
+
+class VolumeStatistics:
+    """
+    Statistics of a volume.  The histogram counts voxels in bins whose representative
+    values are levels: each value for 8 and 16 bit integer volumes, otherwise the upper
+    edges of equal bins between the minimum and maximum.
+    """
+
+    def __init__(self, shape, dtype, minimum, maximum, nonzero, counts, levels):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.nonzero = nonzero
+        self.counts = counts
+        self.levels = levels
+        self.size = int(counts.sum())
+
+    def __repr__(self):
+        return "VolumeStatistics(shape=%s, dtype=%s, minimum=%s, maximum=%s, nonzero=%s)" % (
+            self.shape, self.dtype, self.minimum, self.maximum, self.nonzero)
+
+    @property
+    def value_range(self):
+        return (self.minimum, self.maximum)
+
+    def percentiles(self, percentiles):
+        "Approximate values at the percentiles (0 to 100) from the histogram."
+        cumulative = np.cumsum(self.counts)
+        result = []
+        for p in percentiles:
+            index = np.searchsorted(cumulative, self.size * p / 100.0)
+            result.append(self.levels[min(index, len(self.levels) - 1)])
+        return result
+
+    def percentile(self, p):
+        return self.percentiles([p])[0]
+
+    def otsu_level(self):
+        "The level separating the histogram into two classes of minimal within-class variance (Otsu)."
+        if self.maximum == self.minimum:
+            return self.minimum
+        counts = self.counts.astype(np.float64)
+        levels = self.levels.astype(np.float64)
+        below = np.cumsum(counts)
+        above = self.size - below
+        sums = np.cumsum(counts * levels)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_below = sums / below
+            mean_above = (sums[-1] - sums) / above
+            between = below * above * (mean_below - mean_above) ** 2
+        between[~np.isfinite(between)] = -1
+        return self.levels[int(np.argmax(between))]
+
+    def step(self, positions=255, low=0.5, high=99.5):
+        """
+        Slider step dividing the range between the low and high percentiles into the number of positions
+        (at least 1 for integer volumes), so the slider resolves the values most voxels have.
+        """
+        (lower, upper) = self.percentiles([low, high])
+        span = float(upper - lower)
+        if span <= 0:
+            span = float(self.maximum - self.minimum)
+        step = span / positions
+        if self.dtype.kind in "iub":
+            return max(1, int(step))
+        if step <= 0:
+            return 1
+        return step
+
+def compute_statistics(array, bins=BINS, threads=None):
+    """
+    Statistics of an array (or LazyVolume).  8 and 16 bit integer volumes are counted exactly
+    in a single slab by slab pass; other volumes need a second pass for the histogram.
+    Non-finite values (NaN and infinities) are left out of the range and histogram.
+    """
+    from .loaders import map_slabs
+    began = time.perf_counter()
+    dtype = np.dtype(array.dtype)
+    if dtype.kind in "iub" and dtype.itemsize <= 2:
+        lowest = int(np.iinfo(dtype).min) if dtype.kind != "b" else 0
+        length = 2 ** (8 * dtype.itemsize)
+        def count(start, stop, slab):
+            values = slab.reshape(-1)
+            if lowest != 0:
+                values = values.astype(np.int32) - lowest
+            return np.bincount(values, minlength=length)
+        counts = np.sum(map_slabs(count, array, threads, itemsize=8), axis=0)
+        occupied = np.flatnonzero(counts)
+        (first, last) = (occupied[0], occupied[-1])
+        counts = counts[first:last + 1]
+        levels = np.arange(first + lowest, last + lowest + 1)
+        (minimum, maximum) = (levels[0], levels[-1])
+        nonzero = int(counts.sum())
+        if minimum <= 0 <= maximum:
+            nonzero -= int(counts[-minimum])
+        minimum = dtype.type(minimum)
+        maximum = dtype.type(maximum)
+    else:
+        def summarize(start, stop, slab):
+            values = slab
+            if dtype.kind == "f":
+                finite = np.isfinite(slab)
+                if not finite.all():
+                    values = slab[finite]
+            if values.size == 0:
+                return (None, None, np.count_nonzero(slab), 0)
+            return (values.min(), values.max(), np.count_nonzero(slab), values.size)
+        summaries = map_slabs(summarize, array, threads)
+        nonzero = sum(int(s[2]) for s in summaries)
+        size = sum(int(s[3]) for s in summaries)
+        summaries = [s for s in summaries if s[3] > 0]
+        if not summaries:
+            # no finite values
+            minimum = maximum = dtype.type(0)
+        else:
+            minimum = min(s[0] for s in summaries)
+            maximum = max(s[1] for s in summaries)
+        if maximum == minimum:
+            counts = np.array([size])
+            levels = np.array([maximum], dtype=np.float64)
+        else:
+            bounds = (float(minimum), float(maximum))
+            def count(start, stop, slab):
+                return np.histogram(slab, bins=bins, range=bounds)[0]
+            counts = np.sum(map_slabs(count, array, threads, itemsize=8), axis=0)
+            levels = np.linspace(bounds[0], bounds[1], bins + 1)[1:]
+    profiling.record("statistics", time.perf_counter() - began, profiling.array_bytes(array))
+    return VolumeStatistics(array.shape, dtype, minimum, maximum, nonzero, counts, levels)
+
+def volume_statistics(array, threads=None):
+    """
+    The cached statistics of an array (or LazyVolume), computed on first use.
+    Call invalidate(array) after changing the array in place.
+    """
+    key = id(array)
+    statistics = cache.get(key)
+    if statistics is not None and statistics.shape == tuple(array.shape) and statistics.dtype == array.dtype:
+        return statistics
+    statistics = compute_statistics(array, threads=threads)
+    if key not in cache:
+        # forget the statistics when the array is collected (its id may then be reused).
+        try:
+            weakref.finalize(array, cache.pop, key, None)
+        except TypeError:
+            # not weakly referenceable: don't cache.
+            return statistics
+    cache[key] = statistics
+    return statistics
+
+def invalidate(array):
+    "Forget the cached statistics of an array whose values changed."
+    cache.pop(id(array), None)
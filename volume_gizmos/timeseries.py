@@ -0,0 +1,134 @@
+"""
+Time series of volumes: generate frames with a bounded background read-ahead buffer.
+"""
+
+import asyncio
+import glob
+import os
+import queue
+import threading
+import numpy as np
+from . import loaders
+
+def frames(source, read_ahead=2, convert=None, **options):
+    """
+    Generate the 3d frames of a time series.
+
+    The source may be a 4d array (or LazyVolume), the path of a file containing a 4d array,
+    a glob pattern matching one file per frame (like "klbOut_Cam_Long_*.klb"),
+    or a list of frame file paths.
+    The options are passed to loaders.load_volume and the optional convert function
+    is applied to each frame (for example to convert the dtype).
+    With read_ahead > 0 frames are loaded in a background thread
+    and at most read_ahead loaded frames wait in the buffer.
+    """
+    return ReadAhead(read_frames(source, convert, **options), read_ahead)
+
+def frame_paths(source):
+    "Sorted frame file paths for a glob pattern or list of paths, or None for other sources."
+    if isinstance(source, (list, tuple)):
+        return [os.path.expanduser(path) for path in source]
+    if isinstance(source, str):
+        pattern = os.path.expanduser(source)
+        if glob.has_magic(pattern):
+            paths = sorted(glob.glob(pattern))
+            if not paths:
+                raise ValueError("No frame files match " + repr(source))
+            return paths
+    return None
+
+def read_frames(source, convert=None, **options):
+    "Generate the frames of a time series without read-ahead (see frames)."
+    if convert is None:
+        convert = lambda frame: frame
+    paths = frame_paths(source)
+    if paths is not None:
+        for path in paths:
+            yield convert(loaders.load_volume(path, **options))
+        return
+    if isinstance(source, str):
+        # the 4d array is always read lazily, frame by frame.
+        source = loaders.load_volume(os.path.expanduser(source), **dict(options, lazy=True, ndim=4))
+    assert len(source.shape) == 4, "time series array must be 4d: " + repr(source.shape)
+    for index in range(source.shape[0]):
+        # copy so memory mapped frames are read in the background thread.
+        yield convert(np.array(source[index]))
+
+class ReadAhead:
+    """
+    Iterator which reads up to size items ahead of the consumer in a background thread.
+    Exceptions in the background thread are raised by the consumer.
+    """
+
+    def __init__(self, iterator, size=2):
+        self.iterator = iter(iterator)
+        self.size = size
+        self.done = False
+        self.stopped = threading.Event()
+        if size > 0:
+            self.queue = queue.Queue(maxsize=size)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        try:
+            for item in self.iterator:
+                if not self.put((True, item)):
+                    return
+        except BaseException as e:
+            self.put((False, e))
+        else:
+            self.put((False, None))
+
+    def put(self, entry):
+        "Wait for room in the buffer unless the consumer closed the iterator."
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        if self.size <= 0:
+            return next(self.iterator)
+        (ok, item) = self.queue.get()
+        if ok:
+            return item
+        self.done = True
+        if item is not None:
+            raise item
+        raise StopIteration
+
+    def close(self):
+        "Stop reading ahead and release the buffered items."
+        self.done = True
+        self.stopped.set()
+        if self.size > 0:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+
+async def play(gizmo, frame_iterator, interval=0.0):
+    """
+    Show each frame in turn using gizmo.reload_volume_async (for example a Triptych).
+    The frames must match the shape and dtype of the gizmo volume.
+    Frames are fetched without blocking the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            frame = await loop.run_in_executor(None, next, frame_iterator, None)
+            if frame is None:
+                break
+            await gizmo.reload_volume_async(frame)
+            if interval:
+                await asyncio.sleep(interval)
+    finally:
+        if hasattr(frame_iterator, "close"):
+            frame_iterator.close()
@@ -0,0 +1,328 @@
+"""
+Array transfer to the browser: typed array storage, compressed encodings and their Javascript decoders.
+"""
+
+import zlib
+import numpy as np
+from H5Gizmos import get
+from . import loaders, statistics
+from H5Gizmos.python import gizmo_server, gz_parent_protocol
+
+# Javascript typed array class names for numpy dtypes.
+JS_ARRAY_TYPES = {
+    np.dtype(np.int8): "Int8Array",
+    np.dtype(np.uint8): "Uint8Array",
+    np.dtype(np.int16): "Int16Array",
+    np.dtype(np.uint16): "Uint16Array",
+    np.dtype(np.int32): "Int32Array",
+    np.dtype(np.uint32): "Uint32Array",
+    np.dtype(np.float32): "Float32Array",
+    np.dtype(np.float64): "Float64Array",
+}
+
+# Compressed transfer encodings.
+RLE = "rle"
+DEFLATE = "deflate"
+CODECS = (RLE, DEFLATE)
+
+# Fill a Float32Array from run values and run lengths.
+RLE_DECODE_ARGUMENTS = ["values", "lengths", "size"]
+RLE_DECODE_BODY = """
+    const result = new Float32Array(size);
+    let position = 0;
+    for (let i = 0; i < lengths.length; i++) {
+        const end = position + lengths[i];
+        result.fill(values[i], position, end);
+        position = end;
+    }
+    return result;
+"""
+
+# Inflate zlib compressed bytes to a typed array stored in cache[name]; resolves to the length.
+INFLATE_ARGUMENTS = ["cache", "name", "bytes", "type_name"]
+INFLATE_BODY = """
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return new Response(stream).arrayBuffer().then(function (buffer) {
+        const result = new window[type_name](buffer);
+        cache[name] = result;
+        return result.length;
+    });
+"""
+
+# Copy a slab into a preallocated typed array; returns the offset after the slab.
+SLAB_ASSIGN_ARGUMENTS = ["buffer", "slab", "offset"]
+SLAB_ASSIGN_BODY = """
+    buffer.set(slab, offset);
+    return offset + slab.length;
+"""
+
+# Copy a 3d block into the flat data array of a volume of the given shape at start (k, j, i).
+PATCH_ARGUMENTS = ["data", "shape", "block", "start", "block_shape"]
+PATCH_BODY = """
+    const nj = shape[1], ni = shape[2];
+    const bk = block_shape[0], bj = block_shape[1], bi = block_shape[2];
+    for (let k = 0; k < bk; k++) {
+        for (let j = 0; j < bj; j++) {
+            const source = (k * bj + j) * bi;
+            const target = ((start[0] + k) * nj + start[1] + j) * ni + start[2];
+            data.set(block.subarray(source, source + bi), target);
+        }
+    }
+    return block.length;
+"""
+
+# Expand a proxy volume reduced by integer factors to the full shape (nearest neighbour).
+UPSAMPLE_ARGUMENTS = ["proxy", "proxy_shape", "shape", "factors"]
+UPSAMPLE_BODY = """
+    const nk = shape[0], nj = shape[1], ni = shape[2];
+    const mk = proxy_shape[0], mj = proxy_shape[1], mi = proxy_shape[2];
+    const result = new Float32Array(nk * nj * ni);
+    const columns = new Int32Array(ni);
+    for (let i = 0; i < ni; i++) {
+        columns[i] = Math.min(Math.floor(i / factors[2]), mi - 1);
+    }
+    let index = 0;
+    for (let k = 0; k < nk; k++) {
+        const pk = Math.min(Math.floor(k / factors[0]), mk - 1);
+        for (let j = 0; j < nj; j++) {
+            const row = (pk * mj + Math.min(Math.floor(j / factors[1]), mj - 1)) * mi;
+            for (let i = 0; i < ni; i++) {
+                result[index++] = proxy[row + columns[i]];
+            }
+        }
+    }
+    return result;
+"""
+
+# Override the value range of a volume (so views built on a proxy use the full volume range).
+VALUE_RANGE_ARGUMENTS = ["volume", "min_value", "max_value"]
+VALUE_RANGE_BODY = """
+    volume.min_value = min_value;
+    volume.max_value = max_value;
+"""
+
+# Replace the data of a GPU volume and rerun a view on it, keeping the view state.
+SWAP_ARGUMENTS = ["gpu_volume", "data", "view"]
+SWAP_BODY = """
+    gpu_volume.set_data(data);
+    gpu_volume.push_buffer();
+    if (view.soften_action) {
+        view.soften_action.run();
+        view.soften_promise = view.context.onSubmittedWorkDone();
+    }
+    view.run();
+    return true;
+"""
+
+def js_array_type(dtype):
+    "Javascript typed array class name for a numpy dtype."
+    type_name = JS_ARRAY_TYPES.get(np.dtype(dtype))
+    assert type_name is not None, "No Javascript typed array for dtype: " + repr(dtype)
+    return type_name
+
+async def store_array(dash, array, cache_name, timeout=60, on_copy=None):
+    """
+    Transfer an array to Javascript as a flat typed array stored in the dash object cache.
+    This follows dash.store_array, which copies the array twice (astype and tobytes)
+    and has no converter for uint16, but serves the bytes with an ArrayGetter instead.
+    Other dtypes are sent as float32, the volume data type in Javascript.
+    The bytes are served from a memoryview of the array, so a contiguous array
+    of a typed array dtype is sent without copying; copies are reported to on_copy(reason).
+    Return a reference to the cached typed array.
+    """
+    array = transfer_ready(array, on_copy)
+    if gizmo_server.isnotebook():
+        return dash.cache(cache_name, array.reshape(-1))
+    gizmo = dash.gizmo
+    converter = gizmo.window[js_array_type(array.dtype)]
+    url = gz_parent_protocol.new_identifier("blob")
+    getter = ArrayGetter(url, array, gizmo._manager, "application/x-binary")
+    gizmo._add_getter(url, getter)
+    # Pull the resource on the JS side.
+    try:
+        await get(gizmo.H5Gizmos.store_blob(url, dash.js_object_cache, cache_name, converter), timeout=timeout)
+    finally:
+        gizmo._remove_getter(url)
+    return dash.my(cache_name)
+
+class ArrayGetter(gizmo_server.BytesGetter):
+    """
+    A BytesGetter serving the bytes of a C contiguous array through a memoryview, without copying them.
+    """
+
+    def set_content(self, byte_content, content_type=None, check_sane=True):
+        # BytesGetter.set_content copies to bytes: check the size the same way and keep the view.
+        content = memoryview(byte_content).cast("B")
+        if check_sane and self.get_sanity_limit and content.nbytes > self.get_sanity_limit:
+            raise ValueError("transfers larger than %s not yet supported (%s)" %
+                (self.get_sanity_limit, content.nbytes))
+        if content_type is not None:
+            self.content_type = content_type
+        self.bytes = content
+
+def transfer_ready(array, on_copy=None):
+    """
+    The array (or LazyVolume) as a C contiguous numpy array of a dtype Javascript can receive,
+    copying only when necessary.  Copies are reported to on_copy(reason) if given.
+    """
+    if not isinstance(array, np.ndarray):
+        note_copy(on_copy, "read")
+        array = np.asarray(array)
+    dtype = transfer_dtype(array.dtype)
+    if array.dtype != dtype:
+        # one pass for the conversion and the layout
+        note_copy(on_copy, "astype")
+        return np.ascontiguousarray(array, dtype=dtype)
+    if not array.flags.c_contiguous:
+        note_copy(on_copy, "contiguous")
+        return np.ascontiguousarray(array)
+    return array
+
+def note_copy(on_copy, reason):
+    if on_copy is not None:
+        on_copy(reason)
+
+def transfer_dtype(dtype):
+    "The dtype used to send an array of the given dtype to Javascript."
+    dtype = np.dtype(dtype)
+    if dtype not in JS_ARRAY_TYPES:
+        dtype = np.dtype(np.float32)
+    return dtype
+
+def rle_encode(array):
+    """
+    Run length encode the flattened array.
+    Return (values, lengths) with one entry per run of equal values.
+    """
+    flat = transfer_ready(array).reshape(-1)
+    if flat.size == 0:
+        return (flat[:0], np.zeros((0,), dtype=np.uint32))
+    starts = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate([[0], starts])
+    lengths = np.diff(np.append(starts, flat.size)).astype(np.uint32)
+    return (flat[starts], lengths)
+
+def rle_decode(values, lengths):
+    "Python inverse of rle_encode (flat array)."
+    return np.repeat(values, lengths)
+
+def deflate_encode(array, level=1):
+    "zlib compress the bytes of the array as a uint8 array."
+    data = zlib.compress(memoryview(np.ascontiguousarray(array)).cast("B"), level)
+    return np.frombuffer(data, dtype=np.uint8)
+
+def changed_boxes(old, new):
+    """
+    List bounding boxes (tuples of slices) covering the voxels where two 3d arrays differ:
+    one box for each run of consecutive changed planes along the first axis.
+    """
+    assert old.shape == new.shape and len(new.shape) == 3, "changed_boxes requires matching 3d shapes."
+    n = new.shape[0]
+    planes = np.zeros((n,), dtype=bool)
+    for (start, stop) in loaders.slab_bounds(new):
+        difference = (old[start:stop] != new[start:stop])
+        planes[start:stop] = difference.reshape((stop - start, -1)).any(axis=1)
+    boxes = []
+    changed = np.flatnonzero(planes)
+    if changed.size == 0:
+        return boxes
+    breaks = np.flatnonzero(np.diff(changed) > 1)
+    starts = np.concatenate([[changed[0]], changed[breaks + 1]])
+    stops = np.concatenate([changed[breaks], [changed[-1]]]) + 1
+    for (start, stop) in zip(starts, stops):
+        mask = (old[start:stop] != new[start:stop]).any(axis=0)
+        rows = np.flatnonzero(mask.any(axis=1))
+        columns = np.flatnonzero(mask.any(axis=0))
+        boxes.append((
+            slice(int(start), int(stop)),
+            slice(int(rows[0]), int(rows[-1]) + 1),
+            slice(int(columns[0]), int(columns[-1]) + 1),
+        ))
+    return boxes
+
+def box_size(box):
+    "Number of voxels in a box of slices."
+    return int(np.prod([s.stop - s.start for s in box]))
+
+def narrow_array(array, bits=None):
+    """
+    Narrowest transfer representation of a volume.
+    Return (narrow, scale, offset) where the array values are narrow * scale + offset.
+    See narrowing.
+    """
+    parameters = narrowing(array, bits)
+    (dtype, scale, offset) = parameters
+    return (apply_narrowing(array, parameters), scale, offset)
+
+def narrowing(array, bits=None):
+    """
+    Choose the narrowest transfer representation of a volume as (dtype, scale, offset),
+    where dtype None means the array is sent unchanged.
+
+    8 and 16 bit integer arrays are sent unchanged.  Integer valued arrays with a value
+    range that fits in 16 bits are shifted by their minimum and sent exactly as uint8 or uint16.
+    Otherwise with bits=8 or bits=16 the values are quantized to that many bits,
+    or else sent as float32.
+    """
+    dtype = np.dtype(array.dtype)
+    if dtype in (np.dtype(np.uint8), np.dtype(np.int8), np.dtype(np.uint16), np.dtype(np.int16)):
+        return (None, 1.0, 0.0)
+    (mn, mx) = statistics.volume_statistics(array).value_range
+    (mn, mx) = (float(mn), float(mx))
+    span = mx - mn
+    if span < 65536 and is_integral(array):
+        narrow_type = np.uint8 if span < 256 else np.uint16
+        return (np.dtype(narrow_type), 1.0, mn)
+    if bits is not None and np.isfinite(span):
+        assert bits in (8, 16), "quantization bits must be 8 or 16: " + repr(bits)
+        narrow_type = np.uint8 if bits == 8 else np.uint16
+        scale = 1.0
+        if span > 0:
+            scale = span / (2 ** bits - 1)
+        return (np.dtype(narrow_type), scale, mn)
+    return (np.dtype(np.float32), 1.0, 0.0)
+
+def apply_narrowing(array, parameters, out=None):
+    """
+    Convert an array (or part of the array the parameters were chosen for) with narrowing parameters,
+    into the preallocated out array if it has the right shape and dtype.
+    """
+    (dtype, scale, offset) = parameters
+    if dtype is None or (isinstance(array, np.ndarray) and array.dtype == dtype):
+        return array
+    if out is None or out.shape != array.shape or out.dtype != dtype:
+        out = np.empty(array.shape, dtype=dtype)
+    if dtype == np.dtype(np.float32):
+        return convert_into(array, out)
+    return affine_convert(array, offset, scale, dtype, out)
+
+def is_integral(array):
+    "Test whether all the array values are integers."
+    if np.dtype(array.dtype).kind in "iub":
+        return True
+    results = loaders.map_slabs(lambda start, stop, slab: bool(np.all(np.mod(slab, 1) == 0)), array, itemsize=8)
+    return all(results)
+
+def affine_convert(array, offset, scale, dtype, out=None):
+    "Convert the array to rint((array - offset) / scale) clipped to the range of an unsigned integer dtype."
+    info = np.iinfo(dtype)
+    if out is None:
+        out = np.empty(array.shape, dtype=dtype)
+    def convert(start, stop, slab):
+        converted = slab.astype(float)
+        converted -= offset
+        if scale != 1.0:
+            converted /= scale
+        np.rint(converted, out=converted)
+        np.clip(converted, info.min, info.max, out=converted)
+        out[start:stop] = converted
+    # float64 temporaries are 8 bytes per voxel.
+    loaders.map_slabs(convert, array, itemsize=8)
+    return out
+
+def convert_into(array, out):
+    "Copy the array (or LazyVolume) into the preallocated out array, converting the dtype slab by slab."
+    def convert(start, stop, slab):
+        out[start:stop] = slab
+    loaders.map_slabs(convert, array)
+    return out
@@ -0,0 +1,161 @@
+"""
+Persistent on-disk cache of decoded and converted volumes.
+
+Entries are raw npy files keyed on the source path, size, modification time
+and the conversion parameters, so they can be memory mapped on the next launch.
+The least recently used entries are evicted when the cache exceeds its size cap.
+"""
+
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from . import loaders
+
+# Default size cap for the cache directory in bytes.
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+def default_directory():
+    "The VOLUME_GIZMOS_CACHE environment variable or ~/.cache/volume_gizmos."
+    directory = os.environ.get("VOLUME_GIZMOS_CACHE")
+    if directory is None:
+        directory = os.path.join(os.path.expanduser("~"), ".cache", "volume_gizmos")
+    return directory
+
+class VolumeCache:
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        if directory is None:
+            directory = default_directory()
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, path, parameters=None):
+        "Cache key for a source file and conversion parameters."
+        stat = os.stat(path)
+        description = dict(
+            path=os.path.abspath(path),
+            size=stat.st_size,
+            mtime=stat.st_mtime_ns,
+            parameters=parameters,
+        )
+        text = json.dumps(description, sort_keys=True, default=repr)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+    def array_path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def info_path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, path, parameters=None):
+        """
+        Get the cached (memory mapped array, info dictionary) for the source and parameters,
+        or None if there is no valid entry.
+        """
+        key = self.key(path, parameters)
+        array_path = self.array_path(key)
+        if not os.path.exists(array_path):
+            return None
+        try:
+            array = np.load(array_path, mmap_mode="r")
+            with open(self.info_path(key)) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            # damaged entry
+            self.remove(key)
+            return None
+        # mark as recently used
+        os.utime(array_path)
+        return (array, info)
+
+    def put(self, path, parameters, array, info=None):
+        """
+        Store an array (or LazyVolume) with an info dictionary for the source and parameters.
+        Return the (memory mapped array, info dictionary) for the new entry.
+        Arrays larger than the size cap are not stored and are returned unchanged.
+        """
+        if info is None:
+            info = {}
+        nbytes = int(np.prod(array.shape)) * np.dtype(array.dtype).itemsize
+        if nbytes > self.max_bytes:
+            return (array, info)
+        key = self.key(path, parameters)
+        array_path = self.array_path(key)
+        temp_path = array_path + ".%s.tmp" % os.getpid()
+        target = np.lib.format.open_memmap(temp_path, mode="w+", dtype=array.dtype, shape=array.shape)
+        for (start, stop) in loaders.slab_bounds(array):
+            target[start:stop] = array[start:stop]
+        target.flush()
+        del target
+        with open(self.info_path(key), "w") as f:
+            json.dump(info, f)
+        # atomic replace so concurrent readers never see a partial entry.
+        os.replace(temp_path, array_path)
+        self.evict(keep=key)
+        return (np.load(array_path, mmap_mode="r"), info)
+
+    def cached(self, path, parameters, compute):
+        """
+        Get the (array, info) for the source and parameters from the cache,
+        or else call compute() to get the (array, info) and store it.
+        """
+        found = self.get(path, parameters)
+        if found is not None:
+            return found
+        (array, info) = compute()
+        return self.put(path, parameters, array, info)
+
+    def entries(self):
+        "List of (last use time, bytes, key) for the cache entries, oldest first."
+        result = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".npy"):
+                stat = os.stat(os.path.join(self.directory, filename))
+                result.append((stat.st_mtime, stat.st_size, filename[:-len(".npy")]))
+        result.sort()
+        return result
+
+    def evict(self, keep=None):
+        "Remove least recently used entries (except keep) until the cache fits the size cap."
+        entries = self.entries()
+        total = sum(size for (used, size, key) in entries)
+        for (used, size, key) in entries:
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                self.remove(key)
+                total -= size
+
+    def remove(self, key):
+        for path in (self.array_path(key), self.info_path(key)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def clear(self):
+        for (used, size, key) in self.entries():
+            self.remove(key)
+
+def add_arguments(parser):
+    """
+    Add volume cache options to a command line argument parser.
+    """
+    parser.add_argument('--cache', action='store_true', help='cache converted volumes on disk')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, help='volume cache directory', default=None)
+    parser.add_argument('--cache-max-gb', dest='cache_max_gb', type=float, help='volume cache size cap in GB', default=DEFAULT_MAX_BYTES / 1024 ** 3)
+
+def from_arguments(args):
+    """
+    Get the VolumeCache for parsed command line arguments, or None if caching is not enabled.
+    """
+    if not args.cache:
+        return None
+    return VolumeCache(args.cache_dir, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+
+def cached_or_computed(cache, path, parameters, compute):
+    "Use the cache if it is not None, or else just compute the (array, info)."
+    if cache is None:
+        return compute()
+    return cache.cached(path, parameters, compute)
@@ -0,0 +1,85 @@
+"""
+Registry of volumes already transferred to a browser page, keyed by content,
+so gizmos on the same page share one copy of an array instead of sending it again.
+"""
+
+import hashlib
+import weakref
+import numpy as np
+from . import loaders
+
+# One registry per page (H5Gizmos gizmo).
+registries = weakref.WeakKeyDictionary()
+
+# Object cache name of the page object holding the shared volumes (see VolumeSuper.shared_cache).
+CACHE_NAME = "shared_volumes"
+
+def content_key(array):
+    "Fast content hash of an array (or LazyVolume) including its shape and dtype."
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((tuple(array.shape), np.dtype(array.dtype).str)).encode("utf-8"))
+    if len(array.shape) == 0:
+        digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+    for (start, stop) in loaders.slab_bounds(array):
+        slab = np.ascontiguousarray(array[start:stop])
+        digest.update(memoryview(slab).cast("B"))
+    return digest.hexdigest()
+
+def shared_name(key):
+    "Javascript cache name for the shared volume with the content key."
+    return "shared_volume_" + key
+
+def registry_for(gizmo):
+    "The VolumeRegistry for a page."
+    registry = registries.get(gizmo)
+    if registry is None:
+        registry = registries[gizmo] = VolumeRegistry()
+    return registry
+
+class VolumeRegistry:
+    """
+    Reference counted map from content keys to Javascript cache names.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.counts = {}
+        # Javascript reference to the page object holding the shared volumes by name.
+        self.cache = None
+
+    def acquire(self, key):
+        "Add a reference to the volume with the key and return its cache name, or None if it is not present."
+        name = self.names.get(key)
+        if name is not None:
+            self.counts[key] += 1
+        return name
+
+    def add(self, key, name):
+        "Register a newly transferred volume with one reference."
+        if key in self.names:
+            self.counts[key] += 1
+        else:
+            self.names[key] = name
+            self.counts[key] = 1
+
+    def count(self, key):
+        return self.counts.get(key, 0)
+
+    def release(self, key):
+        """
+        Remove a reference to the volume with the key.
+        Return the cache name if that was the last reference (the caller frees it), or else None.
+        """
+        if key not in self.names:
+            return None
+        self.counts[key] -= 1
+        if self.counts[key] > 0:
+            return None
+        del self.counts[key]
+        return self.names.pop(key)
+
+    def forget(self, key):
+        "Stop sharing the volume with the key (for example because its owner changed it in place); return its cache name."
+        self.counts.pop(key, None)
+        return self.names.pop(key, None)